@@ -0,0 +1,765 @@
+import openai
+import base64
+import asyncio
+import inspect
+import traceback
+from time import perf_counter
+from utils import *
+from io import BytesIO
+from storage import Storage
+from context_store import ContextStore
+from streaming import EditBudget, AsyncStreamingReply, AsyncVoiceReply
+from openai import RateLimitError
+from scheduler import RateLimitTimeout
+from router import FALLBACK_ERRORS
+from transport import PoolStats, openai_http_client, openai_timeout, use_async_telegram_pool
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message, BotCommandScopeChat
+from coalescer import MessageCoalescer
+from dispatcher import CancelToken, Cancelled
+from metrics import metrics, current_command, startup, MetricsServer
+from main import ChatGPT, LockwardBot, CustomMessage, message_photos, sent_file_id
+from main import OPENAI_API_KEY, TELEGRAM_API_KEY, METRICS_PORT, COMPACT_TOKENS, SUMMARY_ENGINE
+from main import build_router, commands_digest, start_warm_up
+
+# asyncio version of the bot: every completion, image and voice request waits on I/O in a
+# single event loop instead of holding a thread. Run it with `python async_bot.py`,
+# main.py keeps the threaded version.
+
+
+class AsyncChatGPT(ChatGPT):
+    def __init__(self, api_key, **kwargs) -> None:
+        super().__init__(api_key, **kwargs)
+        self.compaction_tasks = set()
+
+    def build_openai_client(self, api_key):
+        return openai.AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            timeout=openai_timeout(),
+            http_client=openai_http_client(self.openai_pool, asynchronous=True),
+        )
+
+    def start_compaction(self, chat_id, context: list):
+        # remember runs on the event loop, the summary is written by a task next to it.
+        task = asyncio.get_running_loop().create_task(self.compact(chat_id, context))
+        self.compaction_tasks.add(task)
+        task.add_done_callback(self.compaction_tasks.discard)
+
+    async def compact(self, chat_id, context: list):
+        try:
+            plan = self.compaction(context)
+            if plan is not None:
+                old, args, estimated_tokens = plan
+                completion = await self.scheduler.acall(
+                    lambda: self.openai_client.chat.completions.with_raw_response.create(**args),
+                    chat_id,
+                    estimated_tokens,
+                    self.summary_engine,
+                )
+                self.finish_compaction(chat_id, old, completion, estimated_tokens)
+        except Exception:
+            print(f"Failed to summarize chat {chat_id}! Exception:\n {traceback.format_exc()}")
+        finally:
+            self.end_compaction(chat_id)
+
+    async def image(self, prompt: str, user=None):
+        key = self.image_key(prompt)
+        image = await asyncio.to_thread(self.media_cache.get, key)
+        if image is None:
+            response = await self.scheduler.acall(
+                lambda: self.openai_client.images.with_raw_response.generate(
+                    model="dall-e-3",
+                    prompt=prompt,
+                    n=1,
+                    size=f"{self.image_size}x{self.image_size}",
+                    quality=self.image_quality,
+                    response_format="b64_json",
+                ),
+                user,
+                model="dall-e-3",
+            )
+            image = base64.b64decode(response.data[0].b64_json)
+            await asyncio.to_thread(self.media_cache.put, key, image)
+        return image
+
+    async def stt(self, audio_bytes: bytes, user=None):
+        transcript = await self.scheduler.acall(
+            lambda: self.openai_client.audio.transcriptions.with_raw_response.create(
+                model=self.stt_engine, file=("msg.mp3", BytesIO(audio_bytes))
+            ),
+            user,
+            model=self.stt_engine,
+        )
+        return transcript.text
+
+    async def tts(self, text, user=None):
+        key = self.tts_key(text)
+        audio = await asyncio.to_thread(self.media_cache.get, key)
+        if audio is None:
+            response = await self.scheduler.acall(
+                lambda: self.openai_client.audio.speech.with_raw_response.create(
+                    model=self.tts_engine, voice=self.tts_voice, input=text, response_format="mp3"
+                ),
+                user,
+                model=self.tts_engine,
+            )
+            audio = response.read()
+            await asyncio.to_thread(self.media_cache.put, key, audio)
+        return audio
+
+    async def create_completion(self, args: dict, chat_id, estimated_tokens):
+        models = self.completion_models(args["model"])
+        for i, model in enumerate(models):
+            request = {**args, "model": model}
+            last = i == len(models) - 1
+            try:
+                completion = await self.scheduler.acall(
+                    lambda: self.openai_client.chat.completions.with_raw_response.create(**request),
+                    chat_id,
+                    estimated_tokens,
+                    model,
+                    max_retries=None if last else 0,
+                    on_response=lambda seconds: self.record_completion(model, seconds),
+                )
+            except Exception as e:
+                self.record_completion(model, 0.0, failed=True)
+                if last or not isinstance(e, FALLBACK_ERRORS):
+                    raise e
+                print(f"!! {model} failed ({type(e).__name__}). Falling back to {models[i + 1]} !!")
+                # The next model is charged for the request, not both of them.
+                self.scheduler.refund(estimated_tokens)
+                self.router.fell_back()
+                continue
+            return completion, model
+
+    async def chat(
+        self, prompt: str, chat_id, image_data=None, talking_to=None, cancel=None, flag=None
+    ):
+        messages, max_response_tokens = self.build_messages(prompt, chat_id, image_data, talking_to)
+        self.stop_if_cancelled(cancel, prompt, messages, chat_id)
+        model = self.pick_model(prompt, image_data, flag)
+        args = self.completion_args(messages, max_response_tokens, model=model)
+        estimated_tokens = count_tokens_in_messages(messages, self.model_engine) + max_response_tokens
+
+        for _ in range(3):
+            completion, _ = await self.create_completion(args, chat_id, estimated_tokens)
+            response = completion.choices[0].message
+            usage = completion.usage.total_tokens
+            cached = cached_tokens(completion.usage)
+            self.scheduler.settle(estimated_tokens, usage)
+            if response:
+                break
+            await asyncio.sleep(0.5)
+
+        self.stop_if_cancelled(
+            cancel, prompt, messages, chat_id, response.content, usage, talking_to
+        )
+        if response:
+            self.remember(prompt, messages, chat_id, response.content, talking_to)
+
+        return response.content, usage, cached
+
+    async def chat_stream(
+        self,
+        prompt: str,
+        chat_id,
+        on_delta,
+        image_data=None,
+        talking_to=None,
+        cancel=None,
+        flag=None,
+    ):
+        messages, max_response_tokens = self.build_messages(prompt, chat_id, image_data, talking_to)
+        self.stop_if_cancelled(cancel, prompt, messages, chat_id)
+
+        model = self.pick_model(prompt, image_data, flag)
+        args = self.completion_args(messages, max_response_tokens, stream=True, model=model)
+        prompt_tokens = count_tokens_in_messages(messages, self.model_engine)
+        estimated_tokens = prompt_tokens + max_response_tokens
+
+        start = perf_counter()
+        stream, model = await self.create_completion(args, chat_id, estimated_tokens)
+        response = ""
+        usage = 0
+        cached = 0
+        first_token = True
+        async for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                await stream.close()
+                usage = prompt_tokens + count_text_tokens(response, self.model_engine)
+                self.scheduler.settle(estimated_tokens, usage)
+                self.stop_if_cancelled(
+                    cancel, prompt, messages, chat_id, response, usage, talking_to
+                )
+            if chunk.usage:
+                usage = chunk.usage.total_tokens
+                cached = cached_tokens(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token:
+                    metrics.observe("first_token", perf_counter() - start, model)
+                    first_token = False
+                response += chunk.choices[0].delta.content
+                await on_delta(response)
+        metrics.observe("stream", perf_counter() - start, model)
+        self.scheduler.settle(estimated_tokens, usage)
+
+        if response:
+            self.remember(prompt, messages, chat_id, response, talking_to)
+
+        return response, usage, cached
+
+
+class AsyncLockwardBot(LockwardBot):
+    # Same commands as LockwardBot (see COMMANDS and ADMIN_COMMANDS in main.py), reusing its
+    # report helpers. Blocking helpers that touch the database run in a thread.
+    def __init__(
+        self,
+        chatgpt: AsyncChatGPT,
+        telegram_api_key,
+        storage: Storage = None,
+        stream_responses=True,
+        edit_interval=1.0,
+        pipeline_voice=True,
+        coalesce_window=0.0,
+        media_group_window=0.5,
+        max_connections=20,  # To Telegram
+    ) -> None:
+        self.telegram_pool = PoolStats(metrics, "telegram", max_connections)
+        use_async_telegram_pool(self.telegram_pool)
+        self.bot = AsyncTeleBot(telegram_api_key)
+        self.bot.register_message_handler(self.enqueue_msg, content_types=["text", "photo", "voice"])
+        self.coalescer = MessageCoalescer(
+            self.submit_batch,
+            window=coalesce_window,
+            media_group_window=media_group_window,
+            call_later=lambda delay, callback, *args: asyncio.get_running_loop().call_later(
+                delay, callback, *args
+            ),
+        )
+        self.tasks = set()
+        metrics.gauge("queue_depth", lambda: self.waiting)
+        metrics.gauge("in_flight", lambda: self.in_flight)
+        self.chat_locks = {}  # chat_id -> lock, updates holding or waiting for it, cancel state
+        self.waiting = 0
+        self.in_flight = 0
+        self.stream_responses = stream_responses
+        self.edit_interval = edit_interval
+        self.edit_budget = EditBudget()
+        self.pipeline_voice = pipeline_voice
+        self.chatgpt = chatgpt
+        self.storage = storage if storage is not None else Storage()
+        self.setup_commands()
+        self.polling_ready = False
+        self.webhook_set = None
+        self.starts = 0
+
+    async def send_message_bot(self, chat_id, text, **kwargs):
+        last = None
+        with metrics.timer("send_message"):
+            for t in split_message(text, parse_mode=kwargs.get("parse_mode")):
+                last = await self.send_part(chat_id, t, **kwargs)
+        return last
+
+    async def send_part(self, chat_id, text, **kwargs):
+        ex = None
+        # If message fails, retry 4 more times
+        for _ in range(5):
+            try:
+                return await self.bot.send_message(chat_id, text, **kwargs)
+            except Exception as e:
+                if "can't parse" in str(e):
+                    raise e
+                elif "message is too long" in str(e):
+                    raise e
+                else:
+                    ex = e
+            await asyncio.sleep(0.5)
+        if ex is not None:
+            raise ex
+
+    async def report_error(self, chat_id, username, e: Exception):
+        if username in self.admins:
+            try:
+                await self.send_message_bot(
+                    chat_id,
+                    f"An error has occurred: Exception:\n```{traceback.format_exc()}```",
+                    parse_mode="Markdown",
+                )
+            except Exception as e2:
+                if "can't parse" in str(e2):
+                    await self.send_message_bot(
+                        chat_id, f"An error has occurred: Exception:\n```{traceback.format_exc()}```"
+                    )
+        else:
+            await self.send_message_bot(
+                chat_id,
+                f"An error has occurred. Try clearing the context and try again. If the issue persists contact @carloslockward",
+            )
+            raise e
+
+    async def get_context(self, message: Message):
+        text = await asyncio.to_thread(
+            self.context_report, message.chat.id, message.from_user.full_name
+        )
+        await self.send_message_bot(message.chat.id, text)
+
+    async def get_context_length(self, message: Message):
+        text = await asyncio.to_thread(self.context_length_report, message.chat.id)
+        await self.send_message_bot(message.chat.id, text)
+
+    async def clear_context(self, message: Message):
+        await asyncio.to_thread(self.chatgpt.context.clear, str(message.chat.id))
+        await self.send_message_bot(message.chat.id, "Context has been cleared!")
+
+    async def grant_access(self, message: Message):
+        for reply in await asyncio.to_thread(self.grant_users, message.text):
+            await self.send_message_bot(message.chat.id, reply)
+
+    async def revoke_access(self, message: Message):
+        for reply in await asyncio.to_thread(self.revoke_users, message.text):
+            await self.send_message_bot(message.chat.id, reply)
+
+    async def list_users(self, message: Message):
+        await self.send_message_bot(message.chat.id, await asyncio.to_thread(self.users_report))
+
+    async def get_token_usage(self, message: Message):
+        text = await asyncio.to_thread(self.usage_report, "tokens")
+        await self.send_message_bot(message.chat.id, text)
+
+    async def get_image_usage(self, message: Message):
+        text = await asyncio.to_thread(self.usage_report, "images")
+        await self.send_message_bot(message.chat.id, text)
+
+    async def get_voice_usage(self, message: Message):
+        text = await asyncio.to_thread(self.usage_report, "voice")
+        await self.send_message_bot(message.chat.id, text)
+
+    def queue_report(self):
+        return (
+            f"Queue depth: {self.waiting}\n"
+            f"In flight: {self.in_flight}\n"
+            f"Active chats: {len(self.chat_locks)}\n"
+            f"{self.coalescer_report()}\n"
+            f"{self.scheduler_report()}"
+        )
+
+    async def get_queue_stats(self, message: Message):
+        await self.send_message_bot(message.chat.id, self.queue_report())
+
+    async def get_cache_stats(self, message: Message):
+        await self.send_message_bot(message.chat.id, self.cache_report())
+
+    async def get_perf_stats(self, message: Message):
+        await self.send_message_bot(message.chat.id, self.perf_report())
+
+    async def get_routing_stats(self, message: Message):
+        await self.send_message_bot(message.chat.id, self.routing_report())
+
+    async def generate_voice(self, message: Message):
+        msg = message.text.replace("/audio", "").strip()
+        chat_id = message.chat.id
+        username = message.from_user.username
+
+        if not msg:
+            await self.send_message_bot(
+                chat_id,
+                "You must provide a prompt\\. Usage:\n `/audio <prompt>`",
+                parse_mode="MarkdownV2",
+            )
+            return
+
+        await self.bot.send_chat_action(chat_id=chat_id, action="upload_voice")
+        try:
+            sent = await self.send_media(
+                self.bot.send_voice,
+                chat_id,
+                self.chatgpt.tts_key(msg),
+                lambda: self.chatgpt.tts(msg, str(chat_id)),
+            )
+        except Exception as e:
+            if "safety system" in str(e) or "content filters" in str(e):
+                await self.send_message_bot(
+                    chat_id, "This audio can't be generated because of OpenAI's safety systems."
+                )
+            else:
+                await self.report_error(chat_id, username, e)
+            return
+
+        if sent:
+            self.storage.add_usage("voice", username)
+
+    async def generate_image(self, message: Message):
+        msg = message.text.replace("/image", "").strip()
+        chat_id = message.chat.id
+        username = message.from_user.username
+
+        if not msg:
+            await self.send_message_bot(
+                chat_id,
+                "You must provide a prompt\\. Usage:\n `/image <prompt>`",
+                parse_mode="MarkdownV2",
+            )
+            return
+
+        await self.bot.send_chat_action(chat_id=chat_id, action="upload_photo")
+        try:
+            sent = await self.send_media(
+                self.bot.send_photo,
+                chat_id,
+                self.chatgpt.image_key(msg),
+                lambda: self.chatgpt.image(msg, str(chat_id)),
+            )
+            print(f"Image Generated! Prompt: '{msg}'")
+        except Exception as e:
+            if "safety system" in str(e) or "content filters" in str(e):
+                await self.send_message_bot(
+                    chat_id, "This image can't be generated because of OpenAI's safety systems."
+                )
+            else:
+                await self.report_error(chat_id, username, e)
+            return
+
+        if sent:
+            self.storage.add_usage("images", username)
+
+    async def send_media(self, send, chat_id, key, generate):
+        cache = self.chatgpt.media_cache
+        file_id = cache.file_id(key)
+        if file_id is not None:
+            try:
+                return await send(chat_id, file_id)
+            except Exception as e:
+                print(f"!! Couldn't re-send cached file, uploading it again: {e} !!")
+                cache.forget_file_id(key)
+        media = await generate()
+        if not media or self.is_cancelled(chat_id):
+            return None
+        sent = await send(chat_id, media)
+        if sent_file_id(sent):
+            cache.set_file_id(key, sent_file_id(sent))
+        return sent
+
+    async def command_not_found(self, message: Message):
+        chat_id = message.chat.id
+        await self.bot.send_chat_action(chat_id=chat_id, action="typing")
+        await self.send_message_bot(chat_id, f"Command {message.text.strip().split()[0]} is invalid")
+
+    async def chat(self, message: Message):
+        if message.content_type == "photo":
+            msg = message.caption if message.caption else ""
+        else:
+            msg = message.text
+        chat_id = message.chat.id
+        username = message.from_user.username
+
+        await self.bot.send_chat_action(chat_id=chat_id, action="typing")
+        reply = None
+        voice = None
+        cancel = self.cancel_token(chat_id)
+        try:
+            image_data = None
+            if message.content_type == "photo":
+                msg, detail = self.photo_detail(msg)
+                # Every photo of an album is downloaded at the same time.
+                image_data = list(
+                    await asyncio.gather(
+                        *(self.download_photo(photo, detail) for photo in message_photos(message))
+                    )
+                )
+            elif message.content_type == "voice":
+                msg = await self.chatgpt.stt(
+                    await self.download(message.voice.file_id), str(chat_id)
+                )
+
+            msg, flag = self.model_flag(msg)
+            if message.content_type == "voice":
+                # It is answered with a short voice note, the fast model is enough.
+                flag = "fast"
+
+            if message.content_type == "voice" and self.pipeline_voice:
+                await self.bot.send_chat_action(chat_id=chat_id, action="record_voice")
+                voice = AsyncVoiceReply(
+                    self.bot, chat_id, lambda text: self.chatgpt.tts(text, str(chat_id))
+                )
+                response, usage, cached = await self.chatgpt.chat_stream(
+                    msg,
+                    str(chat_id),
+                    lambda text: voice.update(self.voice_text(text)),
+                    image_data,
+                    message.from_user.full_name,
+                    cancel,
+                    flag,
+                )
+            elif self.stream_responses and message.content_type != "voice":
+                reply = AsyncStreamingReply(self.bot, chat_id, self.edit_budget, self.edit_interval)
+                await reply.start()
+                response, usage, cached = await self.chatgpt.chat_stream(
+                    msg,
+                    str(chat_id),
+                    lambda text: reply.update(self.stream_text(text)),
+                    image_data,
+                    message.from_user.full_name,
+                    cancel,
+                    flag,
+                )
+            else:
+                response, usage, cached = await self.chatgpt.chat(
+                    msg, str(chat_id), image_data, message.from_user.full_name, cancel, flag
+                )
+            if message.content_type == "voice":
+                response = self.voice_response(response)
+            self.storage.add_usage("tokens", username, usage)
+            self.storage.add_usage("cached_tokens", username, cached)
+            if voice is not None and self.voice_text(response):
+                await voice.finish(self.voice_text(response))
+                self.storage.add_usage("voice", username)
+                return
+        except Cancelled as c:
+            if voice is not None:
+                voice.discard()
+            if reply is not None:
+                await self.cancel_reply(reply, c.response)
+            self.storage.add_usage("tokens", username, c.usage)
+            return
+        except (RateLimitError, RateLimitTimeout) as rle:
+            if reply is not None:
+                await reply.discard()
+            if voice is not None:
+                voice.discard()
+            exception_text = traceback.format_exc()
+            if username in self.admins:
+                await self.send_message_bot(
+                    chat_id,
+                    f"OpenAI servers are overloaded. Try again later. \nException:\n```{exception_text}```",
+                    parse_mode="Markdown",
+                )
+            elif "insufficient_quota" in exception_text:
+                await self.send_message_bot(
+                    chat_id, "LockwardGPT is unavailable at the moment. Try again later."
+                )
+            else:
+                await self.send_message_bot(chat_id, "OpenAI servers are overloaded. Try again later.")
+            return
+        except Exception as e:
+            if reply is not None:
+                await reply.discard()
+            if voice is not None:
+                voice.discard()
+            await self.report_error(chat_id, username, e)
+            return
+
+        if not response:
+            if reply is not None:
+                await reply.discard()
+            return
+        if response.startswith("TEXT_REQUESTED_123"):
+            response = response.replace("TEXT_REQUESTED_123", "").strip(":").strip()
+        if response.startswith("IMAGE_REQUESTED_123"):
+            if reply is not None:
+                await reply.discard()
+            image_prompt = response.replace("IMAGE_REQUESTED_123", "").strip(":").strip()
+            await self.generate_image(CustomMessage(image_prompt, message.chat, message.from_user))
+            await self.send_message_bot(chat_id, f'"{image_prompt}"')
+        elif response.startswith("VOICE_REQUESTED_123"):
+            if reply is not None:
+                await reply.discard()
+            audio_prompt = response.replace("VOICE_REQUESTED_123", "").strip(":").strip()
+            await self.generate_voice(CustomMessage(audio_prompt, message.chat, message.from_user))
+        else:
+            await self.send_response(chat_id, response, reply)
+
+    async def download_photo(self, photo_sizes: list, detail):
+        photo = pick_photo_size(photo_sizes, detail)
+        downloaded_file = await self.download(photo.file_id)
+        # Resizing is CPU work, keep it off the event loop.
+        with metrics.timer("prepare_image"):
+            downloaded_file, width, height = await asyncio.to_thread(
+                prepare_image, downloaded_file, detail
+            )
+        return image_part(downloaded_file, width, height, detail)
+
+    async def download(self, file_id):
+        with metrics.timer("download"):
+            file = await self.bot.get_file(file_id)
+            return await self.bot.download_file(file.file_path)
+
+    async def send_response(self, chat_id, response: str, reply: AsyncStreamingReply = None):
+        with metrics.timer("escape_markdown"):
+            escaped = escape_markdown(response)
+        attempts = [
+            (escaped, "MarkdownV2", "!! Couldn't parse Markdown V2 !!"),
+            (response, "Markdown", "!! Couldn't parse Markdown !!"),
+            (response, None, None),
+        ]
+        for text, parse_mode, parse_error in attempts:
+            try:
+                if reply is not None and reply.fits(text):
+                    return await reply.finish(text, parse_mode)
+                if reply is not None:
+                    await reply.discard()
+                    reply = None
+                return await self.send_message_bot(chat_id, text, parse_mode=parse_mode)
+            except Exception as e:
+                if "can't parse" in str(e) and parse_error:
+                    print(parse_error)
+                else:
+                    raise e
+
+    async def handle_msg(self, message: Message):
+        username = message.from_user.username
+        chat_id = message.chat.id
+        if not self.init_admin_cmds and username in self.admins:
+            await self.set_commands(
+                self.admin_command_list + self.command_list,
+                scope=BotCommandScopeChat(chat_id),
+            )
+            self.init_admin_cmds = True
+
+        # Every update runs in its own task. asyncio locks are fair, so updates from the same
+        # chat are still handled one at a time, in the order they arrived.
+        chat = self.chat_locks.setdefault(
+            chat_id,
+            {
+                "lock": asyncio.Lock(),
+                "count": 0,  # Updates holding or waiting for the lock
+                "waiting": 0,
+                "token": None,  # CancelToken of the update being handled
+                "tickets": 0,  # Updates are numbered in arrival order
+                "cancelled": 0,  # Updates numbered below this were dropped by /cancel
+            },
+        )
+        ticket = chat["tickets"]
+        chat["tickets"] += 1
+        chat["count"] += 1
+        chat["waiting"] += 1
+        self.waiting += 1
+        try:
+            async with chat["lock"]:
+                self.waiting -= 1
+                chat["waiting"] -= 1
+                if ticket < chat["cancelled"]:
+                    # Dropped by /cancel while it was waiting.
+                    return
+                self.in_flight += 1
+                chat["token"] = CancelToken()
+                try:
+                    if await asyncio.to_thread(self.storage.has_user, username):
+                        func = self.determine_function(message)
+                        current_command.set(func.__name__)
+                        with metrics.timer("handle"):
+                            result = func(message)
+                            if inspect.isawaitable(result):
+                                await result
+                    else:
+                        await self.send_message_bot(
+                            chat_id,
+                            "You dont have access to LockwardGPT. Ask @carloslockward to grant you access.",
+                        )
+                finally:
+                    chat["token"] = None
+                    self.in_flight -= 1
+        finally:
+            chat["count"] -= 1
+            if chat["count"] == 0:
+                del self.chat_locks[chat_id]
+
+    def cancel_token(self, chat_id):
+        chat = self.chat_locks.get(chat_id)
+        return chat["token"] if chat is not None else None
+
+    async def cancel_reply(self, reply: AsyncStreamingReply, response: str):
+        text = self.stream_text(response)
+        if text.strip() and reply.fits(text):
+            await reply.finish(text)
+        elif not text.strip():
+            await reply.discard()
+
+    async def cancel_response(self, message: Message):
+        chat_id = message.chat.id
+        keep_partial = "keep" in message.text.split()[1:]
+        dropped = self.coalescer.drop(chat_id)
+        running = False
+        chat = self.chat_locks.get(chat_id)
+        if chat is not None:
+            dropped += chat["waiting"]
+            chat["cancelled"] = chat["tickets"]
+            if chat["token"] is not None:
+                running = True
+                chat["token"].cancel(keep_partial)
+        await self.send_message_bot(chat_id, self.cancel_report(running, dropped, keep_partial))
+
+    async def enqueue_msg(self, message: Message):
+        if self.is_cancel(message):
+            if await asyncio.to_thread(self.storage.has_user, message.from_user.username):
+                await self.cancel_response(message)
+        elif self.mergeable(message):
+            self.coalescer.add(
+                message.chat.id, message, message.from_user.id, message.media_group_id
+            )
+        else:
+            self.coalescer.flush(message.chat.id)
+            self.submit(message)
+
+    def submit(self, message: Message):
+        # Tasks start in the order they are created, so they queue on the chat lock in order.
+        task = asyncio.get_running_loop().create_task(self.handle_msg(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def set_commands(self, commands: list, scope=None):
+        key = self.commands_key(scope)
+        digest = commands_digest(commands)
+        if await asyncio.to_thread(self.storage.get_setting, key) == digest:
+            return False
+        await self.bot.set_my_commands(commands, scope=scope)
+        await asyncio.to_thread(self.storage.set_setting, key, digest)
+        return True
+
+    async def publish_commands(self):
+        with startup.phase("commands"):
+            await self.set_commands(self.command_list)
+
+    async def start_listening(self):
+        start = perf_counter()
+        await self.publish_commands()
+        if not self.polling_ready:
+            # Polling doesn't work while a webhook is set.
+            with startup.phase("remove_webhook"):
+                await self.bot.remove_webhook()
+            self.polling_ready = True
+        self.started(start)
+        await self.bot.infinity_polling()
+
+
+async def main(storage: Storage):
+    with startup.phase("context"):
+        context = ContextStore(context_size=20, backend=storage)
+    with startup.phase("chatgpt"):
+        chatgpt = AsyncChatGPT(
+            OPENAI_API_KEY,
+            context=context,
+            context_size=20,
+            compact_tokens=COMPACT_TOKENS,
+            summary_engine=SUMMARY_ENGINE,
+            router=build_router(),
+        )
+    with startup.phase("bot"):
+        bot = AsyncLockwardBot(chatgpt, TELEGRAM_API_KEY, storage)
+    start_warm_up(chatgpt.model_engine)
+    await bot.start_listening()
+
+
+if __name__ == "__main__":
+    with startup.phase("storage"):
+        storage = Storage("lockward.db")
+        storage.import_json("context.json", "users.json")
+    if METRICS_PORT:
+        MetricsServer(metrics, port=METRICS_PORT).start()
+    try:
+        asyncio.run(main(storage))
+    except KeyboardInterrupt:
+        print("Bot is done!")
+    finally:
+        storage.export_json("context.json", "users.json", context_size=20)
+        storage.close()
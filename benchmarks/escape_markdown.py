@@ -0,0 +1,137 @@
+import os
+import re
+import sys
+import random
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import escape_markdown
+
+# Checks that utils.escape_markdown gives exactly the same output as the implementation it
+# replaced on a regression corpus, then times both.
+#
+#   python benchmarks/escape_markdown.py [--fuzz 20000] [--number 200]
+
+
+# The previous implementation, kept as the reference.
+def legacy_escape_outside(text):
+    # Define patterns for markdown styles
+    patterns = [
+        r"\*(.+?)\*",  # Bold
+        r"_(.+?)_",  # Italic
+        r"__(.+?)__",  # Underline
+        r"~(.+?)~",  # Strikethrough
+        r"\|\|(.+?)\|\|",  # Spoiler
+        r"\`(.+?)\`",  # Single line code block
+    ]
+
+    # Function to escape special characters, skipping valid markdown
+    def escape_chars(match):
+        # Check each pattern to see if it matches the entire match group
+        for pattern in patterns:
+            if re.fullmatch(pattern, match.group(0)):
+                return match.group(0)  # Return the markdown unchanged
+        # If no patterns match, escape all matched special characters
+        return re.sub(r"([_*\[\]()~`>#+\-=|{}.!])", r"\\\1", match.group(0))
+
+    # This regex matches any markdown pattern or any special character
+    combined_pattern = r"(\`.+?\`|\*.+?\*|_.+?_|__.+?__|~.+?~|\|\|.+?\|\||[_*[\]()~`>#+\-=|{}.!])"
+
+    temp = re.sub(combined_pattern, escape_chars, text)
+    res = ""
+    for i, char in enumerate(temp):
+        if char in "!(){}[].>#=+-":
+            if i > 0:
+                if temp[i - 1] != "\\":
+                    res += "\\" + char
+                else:
+                    res += char
+            else:
+                res += "\\" + char
+        else:
+            res += char
+
+    return res
+
+
+def legacy_escape_markdown(text: str):
+    res = ""
+    triple_backticks = "```"
+    escape_inside_block = "\\`"
+    inside_code = False
+    for t in text.split(triple_backticks):
+        if inside_code:
+            for ec in escape_inside_block:
+                if ec in t:
+                    t = t.replace(ec, f"\\{ec}")
+        else:
+            t = legacy_escape_outside(t)
+        res += t
+        res += triple_backticks
+        inside_code = not inside_code
+    if res.count(triple_backticks) % 2 != 0:
+        res = res[:-3]
+    return res
+
+
+CORPUS = [
+    "",
+    "Hello world!",
+    "Plain text with a period. And (parentheses) [brackets] {braces}!",
+    "*bold* _italic_ __underline__ ~strike~ ||spoiler|| `code`",
+    "*bold with a dot.* and _italic (with parens)_ and `code.with.dots()`",
+    "Unclosed *bold and _italic and `code and ~strike and ||spoiler",
+    "**double** __double__ ~~double~~ ||| |||| a||b||c",
+    "Across\nlines *bold\nnot* _it\nalic_ `co\nde`",
+    "Already escaped \\. \\! \\( and a backslash at the end \\",
+    "1. First\n2. Second\n- bullet\n+ plus\n> quote\n# heading\n=== rule ===",
+    "Math: 2+2=4, 3-1=2, a*b*c, x_1_2, {a|b}, #tag, 100%!",
+    "Links [text](https://example.com/path?a=1&b=2) and emails name.surname@example.com",
+    "Here is code:\n```python\ndef f(x):\n    return x * 2  # `tick` \\ backslash\n```\nDone.",
+    "Unclosed fence ```python\nprint('hi')",
+    "Two blocks ```a``` middle *b* ```c.d``` end.",
+    "Backticks around fences ````x```` and `` `double` ``",
+    "Emoji 🤖 and accents: ¿Qué tal? ¡Hola! *negrita.*",
+    "_a_b_c_ *a*b*c* `a`b`c` ~a~b~c~ ||a||b||c||",
+    "_ * ` ~ | single specials _* *_ `~ ~`",
+]
+
+FUZZ_ALPHABET = "ab ._*`~|\\\n()[]{}!#+-=>\u00e9"
+
+
+def fuzz_corpus(count, seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choices(FUZZ_ALPHABET, k=rng.randint(0, 60))) for _ in range(count)]
+
+
+def long_answer():
+    # A long, code heavy answer like the ones that made escaping slow.
+    block = (
+        "Here is *how* to do it, step by step (see _notes_ below):\n"
+        "1. Install the package with `pip install thing`.\n"
+        "2. Configure it: {key: value} and [list] items!\n"
+        "```python\nfor i in range(10):\n    print(i * 2)  # `x`\n```\n"
+    )
+    return block * 40
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare escape_markdown with the old version")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Random strings to compare")
+    parser.add_argument("--number", type=int, default=200, help="Timing iterations")
+    args = parser.parse_args()
+
+    corpus = CORPUS + [long_answer()] + fuzz_corpus(args.fuzz)
+    mismatches = [text for text in corpus if escape_markdown(text) != legacy_escape_markdown(text)]
+    print(f"Compared {len(corpus)} texts, {len(mismatches)} mismatches")
+    for text in mismatches[:5]:
+        print(f"  {text!r}\n    new: {escape_markdown(text)!r}\n    old: {legacy_escape_markdown(text)!r}")
+
+    for name, text in (("short", CORPUS[4]), ("long answer", long_answer())):
+        new = timeit.timeit(lambda: escape_markdown(text), number=args.number) / args.number
+        old = timeit.timeit(lambda: legacy_escape_markdown(text), number=args.number) / args.number
+        print(
+            f"{name} ({len(text)} chars): {new * 1e6:.1f}us vs {old * 1e6:.1f}us ({old / new:.1f}x)"
+        )
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,322 @@
+import io
+import json
+import queue
+import threading
+import urllib.parse
+from time import sleep, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the OpenAI and Telegram Bot APIs, for load tests that must not spend tokens
+# or talk to real users. They answer just enough of each API for the bot to run, with
+# configurable latency, and are meant to run in their own process so their CPU time isn't
+# counted as the bot's. See load_test.py.
+
+WORDS = "the quick brown fox jumps over the lazy dog while the bot keeps answering".split()
+
+
+def fake_text(tokens):
+    # Roughly one token per word.
+    return " ".join(WORDS[i % len(WORDS)] for i in range(tokens)) + "."
+
+
+def fake_jpeg(size=640):
+    # A real image, photos are downscaled with PIL before they are sent to OpenAI.
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), (90, 120, 200)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FakeServer:
+    # Keep-alive HTTP server that hands every request to route(handler, method, path, query).
+    def __init__(self, host="127.0.0.1", port=0) -> None:
+        self.httpd = ThreadingHTTPServer((host, port), self.__handler())
+        self.httpd.daemon_threads = True
+        self.requests = 0
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Clients keep their connections, like they do with the real APIs.
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.__route("GET")
+
+            def do_POST(self):
+                self.__route("POST")
+
+            def __route(self, method):
+                url = urllib.parse.urlparse(self.path)
+                query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                self.body = self.rfile.read(length) if length else b""
+                server.requests += 1
+                server.route(self, method, url.path, query)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def json_body(self, handler):
+        if handler.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(handler.body or b"{}")
+        if handler.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            return {k: v[-1] for k, v in urllib.parse.parse_qs(handler.body.decode()).items()}
+        return {}
+
+    def reply(self, handler, body, status=200, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def route(self, handler, method, path, query):
+        self.reply(handler, {"error": f"{method} {path} not found"}, status=404)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeOpenAI(FakeServer):
+    # Chat completions (streamed or not), image generation, speech and transcriptions.
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        first_token_latency=0.5,  # Seconds before the first token of a completion
+        token_interval=0.02,  # Seconds between streamed tokens
+        response_tokens=60,
+        image_latency=3.0,
+        tts_latency=0.6,
+        stt_latency=0.4,
+    ) -> None:
+        super().__init__(host, port)
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.response_tokens = response_tokens
+        self.image_latency = image_latency
+        self.tts_latency = tts_latency
+        self.stt_latency = stt_latency
+
+    def rate_limit_headers(self):
+        # Plenty of room, the harness measures the bot and not the scheduler's waiting.
+        return {
+            "x-ratelimit-limit-requests": "100000",
+            "x-ratelimit-remaining-requests": "99999",
+            "x-ratelimit-reset-requests": "1ms",
+            "x-ratelimit-limit-tokens": "100000000",
+            "x-ratelimit-remaining-tokens": "99999999",
+            "x-ratelimit-reset-tokens": "1ms",
+        }
+
+    def route(self, handler, method, path, query):
+        if method == "POST" and path.endswith("/chat/completions"):
+            self.chat(handler)
+        elif method == "POST" and path.endswith("/images/generations"):
+            sleep(self.image_latency)
+            data = {"b64_json": "ZmFrZSBpbWFnZQ==", "revised_prompt": "fake image"}
+            self.reply(handler, {"created": int(time()), "data": [data]}, headers=self.rate_limit_headers())
+        elif method == "POST" and path.endswith("/audio/speech"):
+            sleep(self.tts_latency)
+            self.reply(handler, b"fake speech", content_type="audio/mpeg", headers=self.rate_limit_headers())
+        elif method == "POST" and path.endswith("/audio/transcriptions"):
+            sleep(self.stt_latency)
+            self.reply(handler, {"text": fake_text(12)}, headers=self.rate_limit_headers())
+        else:
+            super().route(handler, method, path, query)
+
+    def chat(self, handler):
+        request = self.json_body(handler)
+        model = request.get("model", "")
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in request.get("messages", []))
+        tokens = min(self.response_tokens, request.get("max_tokens") or self.response_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": tokens,
+            "total_tokens": prompt_tokens + tokens,
+        }
+        sleep(self.first_token_latency)
+        if not request.get("stream"):
+            sleep(self.token_interval * tokens)
+            message = {"role": "assistant", "content": fake_text(tokens)}
+            self.reply(
+                handler,
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                    "usage": usage,
+                },
+                headers=self.rate_limit_headers(),
+            )
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        for name, value in self.rate_limit_headers().items():
+            handler.send_header(name, value)
+        handler.end_headers()
+
+        def chunk(choices, usage=None):
+            event = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time()),
+                "model": model,
+                "choices": choices,
+            }
+            if usage is not None:
+                event["usage"] = usage
+            data = f"data: {json.dumps(event)}\n\n".encode("utf-8")
+            handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            handler.wfile.flush()
+
+        try:
+            words = fake_text(tokens).split(" ")
+            for i, word in enumerate(words):
+                if i:
+                    sleep(self.token_interval)
+                delta = {"content": word if i == 0 else " " + word}
+                if i == 0:
+                    delta["role"] = "assistant"
+                chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+            chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (request.get("stream_options") or {}).get("include_usage"):
+                chunk([], usage)
+            done = b"data: [DONE]\n\n"
+            handler.wfile.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The bot closed the stream, a cancelled response.
+            handler.close_connection = True
+
+
+class FakeTelegram(FakeServer):
+    # The Bot API methods the bot calls. Updates to hand out on getUpdates are posted as a JSON
+    # list to /_updates, GET /_stats counts the calls of each method.
+    def __init__(self, host="127.0.0.1", port=0, latency=0.02, download_latency=0.05) -> None:
+        super().__init__(host, port)
+        self.latency = latency
+        self.download_latency = download_latency
+        self.updates = queue.Queue()
+        self.lock = threading.Lock()
+        self.message_ids = 1_000_000
+        self.photo = None
+        self.calls = {}
+
+    def message(self, chat_id, **content):
+        with self.lock:
+            self.message_ids += 1
+            message_id = self.message_ids
+        message = {
+            "message_id": message_id,
+            "date": int(time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "LockwardGPT", "username": "lockward_bot"},
+        }
+        message.update(content)
+        return message
+
+    def result(self, handler, result):
+        self.reply(handler, {"ok": True, "result": result})
+
+    def route(self, handler, method, path, query):
+        if path == "/_updates":
+            for update in json.loads(handler.body):
+                self.updates.put(update)
+            self.result(handler, True)
+            return
+        if path == "/_stats":
+            self.result(handler, self.stats())
+            return
+        parts = path.strip("/").split("/")
+        if parts[0] == "file":
+            # /file/bot<token>/<file_path>
+            sleep(self.download_latency)
+            if parts[-1].endswith(".jpg"):
+                if self.photo is None:
+                    self.photo = fake_jpeg()
+                self.reply(handler, self.photo, content_type="image/jpeg")
+            else:
+                self.reply(handler, b"OggS fake voice note", content_type="audio/ogg")
+            return
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            super().route(handler, method, path, query)
+            return
+        name = parts[1]
+        params = {**query, **self.json_body(handler)}
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if name == "getUpdates":
+            self.get_updates(handler, params)
+            return
+        sleep(self.latency)
+        chat_id = params.get("chat_id", 0)
+        if name == "getMe":
+            self.result(handler, {"id": 1, "is_bot": True, "first_name": "LockwardGPT", "username": "lockward_bot"})
+        elif name == "getFile":
+            file_id = params["file_id"]
+            extension = "jpg" if file_id.startswith("photo") else "oga"
+            file = {"file_id": file_id, "file_unique_id": file_id, "file_size": 1024}
+            self.result(handler, {**file, "file_path": f"files/{file_id}.{extension}"})
+        elif name in ("sendMessage", "editMessageText"):
+            message = self.message(chat_id, text=params.get("text", ""))
+            if "message_id" in params:
+                message["message_id"] = int(params["message_id"])
+            self.result(handler, message)
+        elif name == "sendVoice":
+            voice = {"file_id": "voice-sent", "file_unique_id": "voice-sent", "duration": 3}
+            self.result(handler, self.message(chat_id, voice=voice))
+        elif name == "sendPhoto":
+            photo = {"file_id": "photo-sent", "file_unique_id": "photo-sent", "width": 1024, "height": 1024}
+            self.result(handler, self.message(chat_id, photo=[photo]))
+        else:
+            # sendChatAction, deleteMessage, setMyCommands, deleteWebhook...
+            self.result(handler, True)
+
+    def get_updates(self, handler, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait())
+            while len(updates) < int(params.get("limit") or 100):
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        self.result(handler, [u for u in updates if u["update_id"] >= offset])
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+
+def serve(server_class, ports, **options):
+    # Target of the process running a fake server, its port is put on the `ports` queue.
+    server = server_class(**options)
+    ports.put(server.port)
+    server.serve_forever()
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import urllib.request
+from collections import deque
+from time import sleep, time, monotonic, perf_counter, process_time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import openai
+import telebot
+from main import ChatGPT, LockwardBot
+from storage import Storage
+from context_store import ContextStore
+from media_cache import MediaCache
+from webhook_replay import load_updates
+from transport import openai_http_client, openai_timeout
+from fakes import FakeOpenAI, FakeTelegram, serve
+
+# Replays Telegram updates against a LockwardBot wired to local OpenAI and Telegram stand-ins
+# (see fakes.py) and reports end-to-end latency, throughput and CPU time per message.
+#
+#   python benchmarks/load_test.py [--messages 500 --chats 50 --rate 20] [--trace updates.jsonl]
+#
+# Latency is measured from handing an update to the bot until its handler returned, so it
+# includes waiting in the chat's queue. The fakes run in their own processes, the CPU time is
+# the bot's alone.
+
+PROMPTS = [
+    "Hi! How are you?",
+    "Write a haiku about the sea",
+    "What is the capital of Australia?",
+    "Explain recursion to a five year old",
+    "Give me three ideas for dinner",
+    "Translate 'good morning' to French, German and Italian",
+]
+
+
+def synthetic_trace(messages, chats, voice_ratio=0.1, photo_ratio=0.05, image_ratio=0.02, seed=0):
+    rng = random.Random(seed)
+    updates = []
+    message_ids = {}
+    for i in range(messages):
+        chat = rng.randrange(chats)
+        message_ids[chat] = message_ids.get(chat, 0) + 1
+        message = {
+            "message_id": message_ids[chat],
+            "date": 0,
+            "chat": {"id": 10_000 + chat, "type": "private"},
+            "from": {
+                "id": 10_000 + chat,
+                "is_bot": False,
+                "first_name": "Load",
+                "username": f"load_user_{chat}",
+            },
+        }
+        roll = rng.random()
+        if roll < voice_ratio:
+            message["voice"] = {
+                "file_id": f"voice-{i}",
+                "file_unique_id": f"voice-{i}",
+                "duration": 4,
+                "mime_type": "audio/ogg",
+            }
+        elif roll < voice_ratio + photo_ratio:
+            message["photo"] = [
+                {"file_id": f"photo-{i}", "file_unique_id": f"photo-{i}", "width": 640, "height": 640}
+            ]
+            message["caption"] = "What is in this picture?"
+        elif roll < voice_ratio + photo_ratio + image_ratio:
+            message["text"] = f"/image a lighthouse at dusk, take {i}"
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+        else:
+            message["text"] = rng.choice(PROMPTS)
+        updates.append({"update_id": i + 1, "message": message})
+    return updates
+
+
+class LatencyTracker:
+    # Messages of a chat are handled in order, and a batch of coalesced messages finishes with its
+    # last one, so finishing a message finishes everything sent before it in the chat.
+    def __init__(self) -> None:
+        self.lock = threading.Condition()
+        self.pending = {}  # chat_id -> deque of (message_id, sent at)
+        self.latencies = []
+        self.rejected = 0
+        self.first_sent = None
+        self.last_done = None
+
+    def sent(self, chat_id, message_id):
+        now = perf_counter()
+        with self.lock:
+            if self.first_sent is None:
+                self.first_sent = now
+            self.pending.setdefault(chat_id, deque()).append((message_id, now))
+
+    def done(self, chat_id, message_id):
+        now = perf_counter()
+        with self.lock:
+            queue = self.pending.get(chat_id)
+            while queue and queue[0][0] <= message_id:
+                self.latencies.append(now - queue.popleft()[1])
+            self.last_done = now
+            self.lock.notify_all()
+
+    def reject(self, chat_id, message_id):
+        # The dispatcher's queue was full, the message won't be answered.
+        with self.lock:
+            queue = self.pending.get(chat_id, ())
+            for entry in queue:
+                if entry[0] == message_id:
+                    queue.remove(entry)
+                    self.rejected += 1
+                    break
+            self.lock.notify_all()
+
+    def wait(self, total, timeout):
+        with self.lock:
+            return self.lock.wait_for(
+                lambda: len(self.latencies) + self.rejected >= total, timeout
+            )
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def start_fake(server_class, **options):
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve, args=(server_class, ports), kwargs=options, daemon=True
+    )
+    process.start()
+    return process, ports.get(timeout=10)
+
+
+def fetch_json(url, data=None):
+    body = None if data is None else json.dumps(data).encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def build_bot(args, openai_port, telegram_port, workdir, usernames):
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{telegram_port}/bot{{0}}/{{1}}"
+    telebot.apihelper.FILE_URL = f"http://127.0.0.1:{telegram_port}/file/bot{{0}}/{{1}}"
+    storage = Storage(os.path.join(workdir, "load_test.db"))
+    for username in usernames:
+        storage.add_user(username)
+    storage.flush()
+    context = ContextStore(context_size=20, backend=storage)
+    chatgpt = ChatGPT(
+        "sk-load-test",
+        context=context,
+        context_size=20,
+        media_cache=MediaCache(os.path.join(workdir, "media_cache")),
+    )
+    chatgpt.openai_client = openai.OpenAI(
+        api_key="sk-load-test",
+        base_url=f"http://127.0.0.1:{openai_port}/v1",
+        max_retries=0,
+        timeout=openai_timeout(),
+        http_client=openai_http_client(chatgpt.openai_pool),
+    )
+    bot = LockwardBot(
+        chatgpt,
+        "123456:LOAD-TEST",
+        storage,
+        max_workers=args.workers,
+        max_pending=args.max_pending,
+        stream_responses=not args.no_stream,
+        edit_interval=args.edit_interval,
+        coalesce_window=args.coalesce_window,
+    )
+    return bot, storage
+
+
+def run(args):
+    if args.trace:
+        updates = [u for u in load_updates(args.trace) if "message" in u]
+    else:
+        updates = synthetic_trace(
+            args.messages, args.chats, args.voice_ratio, args.photo_ratio, args.image_ratio, args.seed
+        )
+    usernames = {u["message"]["from"].get("username") for u in updates}
+
+    openai_process, openai_port = start_fake(
+        FakeOpenAI,
+        first_token_latency=args.first_token_latency,
+        token_interval=args.token_interval,
+        response_tokens=args.response_tokens,
+        image_latency=args.image_latency,
+        tts_latency=args.tts_latency,
+        stt_latency=args.stt_latency,
+    )
+    telegram_process, telegram_port = start_fake(FakeTelegram, latency=args.telegram_latency)
+    workdir = tempfile.mkdtemp(prefix="lockward_load_")
+    bot, storage = build_bot(args, openai_port, telegram_port, workdir, usernames)
+
+    tracker = LatencyTracker()
+    handler = bot.dispatcher.handler
+
+    def timed_handler(message):
+        try:
+            handler(message)
+        finally:
+            tracker.done(message.chat.id, message.message_id)
+
+    bot.dispatcher.handler = timed_handler
+    submit = bot.dispatcher.submit
+
+    def tracked_submit(chat_id, message):
+        if submit(chat_id, message):
+            return True
+        tracker.reject(chat_id, message.message_id)
+        return False
+
+    bot.dispatcher.submit = tracked_submit
+
+    polling = None
+    if args.polling:
+        polling = threading.Thread(
+            target=bot.bot.infinity_polling,
+            kwargs={"timeout": 10, "long_polling_timeout": 1},
+            daemon=True,
+        )
+        polling.start()
+
+    print(f"Replaying {len(updates)} updates at {args.rate or 'max'}/s...")
+    cpu_start = process_time()
+    start = monotonic()
+    for i, update in enumerate(updates):
+        if args.rate:
+            sleep(max(start + i / args.rate - monotonic(), 0))
+        update["message"]["date"] = int(time())
+        message = update["message"]
+        tracker.sent(message["chat"]["id"], message["message_id"])
+        if polling is not None:
+            fetch_json(f"http://127.0.0.1:{telegram_port}/_updates", [update])
+        else:
+            bot.process_update(update)
+    finished = tracker.wait(len(updates), args.timeout)
+    cpu = process_time() - cpu_start
+
+    with tracker.lock:
+        latencies = list(tracker.latencies)
+        elapsed = (tracker.last_done or perf_counter()) - tracker.first_sent
+    report = {
+        "messages": len(updates),
+        "completed": len(latencies),
+        "timed_out": not finished,
+        "rejected": tracker.rejected,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies, default=0.0),
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "cpu_seconds": cpu,
+        "cpu_per_message": cpu / len(latencies) if latencies else 0.0,
+        "telegram_calls": fetch_json(f"http://127.0.0.1:{telegram_port}/_stats")["result"],
+    }
+
+    if polling is not None:
+        bot.bot.stop_polling()
+    bot.dispatcher.shutdown()
+    storage.close()
+    for process in (openai_process, telegram_process):
+        process.terminate()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return report
+    print(
+        f"Completed {report['completed']}/{report['messages']} messages"
+        + (" (timed out)" if report["timed_out"] else "")
+        + f", rejected {report['rejected']}"
+    )
+    print(f"Latency: p50 {report['p50']:.3f}s, p99 {report['p99']:.3f}s, max {report['max']:.3f}s")
+    print(f"Throughput: {report['throughput']:.2f} messages/s")
+    print(f"CPU: {report['cpu_seconds']:.2f}s, {report['cpu_per_message'] * 1000:.2f}ms per message")
+    print(f"Telegram calls: {report['telegram_calls']}")
+    print(bot.perf_report())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the bot against local fake APIs")
+    parser.add_argument("--trace", help="JSON list or JSON lines file with Telegram updates")
+    parser.add_argument("--messages", type=int, default=200, help="Synthetic messages to send")
+    parser.add_argument("--chats", type=int, default=20, help="Synthetic chats to spread them on")
+    parser.add_argument("--voice-ratio", type=float, default=0.1)
+    parser.add_argument("--photo-ratio", type=float, default=0.05)
+    parser.add_argument("--image-ratio", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=10, help="Updates per second, 0 for no limit")
+    parser.add_argument("--polling", action="store_true", help="Receive updates with getUpdates")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for answers")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-pending", type=int, default=200)
+    parser.add_argument("--no-stream", action="store_true", help="Disable streamed responses")
+    parser.add_argument("--edit-interval", type=float, default=1.0)
+    parser.add_argument("--coalesce-window", type=float, default=0.0)
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--image-latency", type=float, default=3.0)
+    parser.add_argument("--tts-latency", type=float, default=0.6)
+    parser.add_argument("--stt-latency", type=float, default=0.4)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    run(parser.parse_args())
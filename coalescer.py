@@ -0,0 +1,95 @@
+import threading
+from time import monotonic
+
+
+def start_timer(delay, callback, *args):
+    timer = threading.Timer(delay, callback, args)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class MessageCoalescer:
+    # Holds the messages a user sends in a burst and hands them to on_batch together, so they
+    # become a single user turn instead of one completion each. A batch is handed over once
+    # nothing new arrived for `window` seconds, or after max_delay no matter what. Albums come
+    # in as one message per photo, their messages always wait at least media_group_window.
+    # Batches are handed over in order and before anything else of the same chat, call flush
+    # before handling a message that isn't added here.
+    def __init__(
+        self,
+        on_batch,
+        window=0.0,
+        media_group_window=0.5,
+        max_delay=3.0,
+        max_messages=10,
+        call_later=start_timer,  # (delay, callback, *args) -> something with cancel()
+    ) -> None:
+        self.on_batch = on_batch
+        self.window = window
+        self.media_group_window = media_group_window
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self.call_later = call_later
+        self.lock = threading.RLock()
+        self.batches = {}  # chat_id -> {"sender", "messages", "started", "timer"}
+        self.coalesced = 0
+
+    def add(self, chat_id, message, sender=None, media_group_id=None):
+        window = self.window
+        if media_group_id is not None:
+            window = max(window, self.media_group_window)
+        with self.lock:
+            batch = self.batches.get(chat_id)
+            if batch is not None and batch["sender"] != sender:
+                # Someone else wrote in the group, their messages are a different turn.
+                self.flush(chat_id)
+                batch = None
+            if batch is None:
+                if window <= 0:
+                    self.on_batch([message])
+                    return
+                batch = {"sender": sender, "messages": [], "started": monotonic(), "timer": None}
+                self.batches[chat_id] = batch
+            else:
+                batch["timer"].cancel()
+                self.coalesced += 1
+            batch["messages"].append(message)
+            delay = min(window, batch["started"] + self.max_delay - monotonic())
+            if delay <= 0 or len(batch["messages"]) >= self.max_messages:
+                self.flush(chat_id)
+            else:
+                size = len(batch["messages"])
+                batch["timer"] = self.call_later(delay, self.__expire, chat_id, batch, size)
+
+    def __expire(self, chat_id, batch, size):
+        with self.lock:
+            # A timer that fired while a new message was being added is stale.
+            if self.batches.get(chat_id) is batch and len(batch["messages"]) == size:
+                self.flush(chat_id)
+
+    def flush(self, chat_id):
+        with self.lock:
+            batch = self.batches.pop(chat_id, None)
+            if batch is None:
+                return
+            if batch["timer"] is not None:
+                batch["timer"].cancel()
+            # Still holding the lock, so nothing of this chat can be handed over before it.
+            self.on_batch(batch["messages"])
+
+    def drop(self, chat_id):
+        # Forgets the messages waiting in the chat, returns how many there were.
+        with self.lock:
+            batch = self.batches.pop(chat_id, None)
+            if batch is None:
+                return 0
+            batch["timer"].cancel()
+            return len(batch["messages"])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "waiting_chats": len(self.batches),
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,182 @@
+import json
+import threading
+from pathlib import Path
+from collections import OrderedDict, deque
+
+
+def message_size(message: dict):
+    # Rough size in memory of a context message, good enough to keep a budget.
+    return len(json.dumps(message)) + 100
+
+
+class DiskBackend:
+    # Keeps one JSON file per chat. Messages are only written when a chat leaves memory.
+    def __init__(self, path="contexts") -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __file(self, chat_id):
+        return self.path / f"{chat_id}.json"
+
+    def exists(self):
+        return any(self.path.iterdir())
+
+    def load(self, chat_id, limit):
+        file = self.__file(chat_id)
+        if not file.exists():
+            return []
+        try:
+            with file.open("r") as cf:
+                return json.load(cf)[-limit:]
+        except:
+            print(f"Failed to load context of chat {chat_id}!")
+            return []
+
+    def append(self, chat_id, message):
+        pass
+
+    def save(self, chat_id, messages):
+        with self.__file(chat_id).open("w") as cf:
+            json.dump(messages, cf)
+
+    def replace(self, chat_id, messages):
+        self.save(chat_id, messages)
+
+    def clear(self, chat_id):
+        self.__file(chat_id).unlink(missing_ok=True)
+
+    def chat_ids(self):
+        return [file.stem for file in self.path.glob("*.json")]
+
+
+def has_summary(chat):
+    return len(chat) > 0 and chat[0]["role"] == "system"
+
+
+class ContextStore:
+    # Per chat context kept as a ring buffer of the last context_size messages. Old turns are
+    # dropped whole, so the context always starts with a prompt. When the messages in memory go
+    # over memory_budget bytes, the least recently used chats are moved to the backend and
+    # loaded back the next time they are needed. A chat can start with a system message
+    # summarizing what fell out of it (see compact), that one is never dropped and doesn't count
+    # towards context_size.
+    def __init__(self, context_size=10, memory_budget=50_000_000, backend=None) -> None:
+        self.context_size = context_size
+        self.memory_budget = memory_budget
+        self.backend = backend if backend is not None else DiskBackend()
+        self.lock = threading.RLock()
+        self.chats = OrderedDict()  # chat_id -> deque, most recently used last
+        self.sizes = {}
+        self.dirty = set()
+        self.memory_used = 0
+        self.evictions = 0
+
+    def __chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            # One more, in case the summary is among the newest messages.
+            chat = deque(self.backend.load(chat_id, self.context_size + 1))
+            self.__fit(chat)
+            self.chats[chat_id] = chat
+            self.sizes[chat_id] = sum(message_size(m) for m in chat)
+            self.memory_used += self.sizes[chat_id]
+        else:
+            self.chats.move_to_end(chat_id)
+        return chat
+
+    def __fit(self, chat: deque):
+        # Drops the oldest turns until the chat fits in context_size, and a reply whose prompt
+        # was dropped along with them. Returns the size of what was dropped.
+        oldest = 1 if has_summary(chat) else 0
+        dropped = 0
+        while len(chat) > oldest and (
+            len(chat) - oldest > self.context_size or chat[oldest]["role"] != "user"
+        ):
+            dropped += message_size(chat[oldest])
+            del chat[oldest]
+        return dropped
+
+    def __evict(self):
+        # Never evict the chat that was just used, it's the last one.
+        while self.memory_used > self.memory_budget and len(self.chats) > 1:
+            chat_id, chat = self.chats.popitem(last=False)
+            if chat_id in self.dirty:
+                self.backend.save(chat_id, list(chat))
+                self.dirty.discard(chat_id)
+            self.memory_used -= self.sizes.pop(chat_id)
+            self.evictions += 1
+
+    def messages(self, chat_id):
+        with self.lock:
+            messages = list(self.__chat(chat_id))
+            self.__evict()
+            return messages
+
+    def append(self, chat_id, *messages):
+        with self.lock:
+            chat = self.__chat(chat_id)
+            size = 0
+            for message in messages:
+                size += message_size(message)
+                chat.append(message)
+                self.backend.append(chat_id, message)
+            size -= self.__fit(chat)
+            self.sizes[chat_id] += size
+            self.memory_used += size
+            self.dirty.add(chat_id)
+            self.__evict()
+
+    def compact(self, chat_id, old: list, summary: dict):
+        # Replaces the oldest messages of the chat with a summary of them, also when some of them
+        # fell out of the chat while the summary was written. Returns False, and leaves the chat
+        # alone, when the rest of them are no longer the oldest ones.
+        with self.lock:
+            chat = self.__chat(chat_id)
+            start = 1 if has_summary(old) else 0
+            if has_summary(chat) != bool(start) or (start and chat[0] != old[0]):
+                return False
+            turns, old_turns = list(chat)[start:], old[start:]
+            for dropped in range(len(old_turns)):
+                rest = old_turns[dropped:]
+                if turns[: len(rest)] == rest:
+                    break
+            else:
+                return False
+            messages = deque([summary] + turns[len(rest) :])
+            self.__fit(messages)
+            size = sum(message_size(m) for m in messages)
+            self.chats[chat_id] = messages
+            self.memory_used += size - self.sizes[chat_id]
+            self.sizes[chat_id] = size
+            self.backend.replace(chat_id, list(messages))
+            self.dirty.discard(chat_id)
+            self.__evict()
+            return True
+
+    def clear(self, chat_id):
+        with self.lock:
+            if chat_id in self.chats:
+                self.memory_used -= self.sizes.pop(chat_id)
+                del self.chats[chat_id]
+            self.dirty.discard(chat_id)
+            self.backend.clear(chat_id)
+
+    def import_context(self, context: dict):
+        # Loads a {chat_id: [messages]} dict, like the old context.json.
+        for chat_id, messages in context.items():
+            self.append(str(chat_id), *messages[-self.context_size :])
+
+    def save(self):
+        with self.lock:
+            for chat_id in self.dirty:
+                self.backend.save(chat_id, list(self.chats[chat_id]))
+            self.dirty.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "chats_in_memory": len(self.chats),
+                "memory_used": self.memory_used,
+                "memory_budget": self.memory_budget,
+                "evictions": self.evictions,
+            }
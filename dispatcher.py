@@ -0,0 +1,130 @@
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Cancelled(Exception):
+    # Raised when /cancel stops a response, with whatever was generated until then.
+    def __init__(self, response="", usage=0) -> None:
+        super().__init__("Cancelled by the user")
+        self.response = response
+        self.usage = usage
+
+
+class CancelToken:
+    # Set by /cancel while an update of the chat is being handled. Long running work checks it
+    # between steps, a streamed completion after every chunk.
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.keep_partial = False
+
+    def cancel(self, keep_partial=False):
+        self.keep_partial = keep_partial
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+
+class ChatDispatcher:
+    # Runs updates from different chats concurrently on a bounded pool of workers, while updates
+    # that belong to the same chat are handled strictly one after the other, in arrival order.
+    def __init__(self, handler, max_workers=8, max_pending=200, max_pending_per_chat=20) -> None:
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_pending_per_chat = max_pending_per_chat
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # chat_id -> updates waiting for the one currently being handled in that chat
+        self.queues = {}
+        # chat_id -> CancelToken of the update currently being handled in that chat
+        self.tokens = {}
+        self.pending = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+    def submit(self, chat_id, update):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                if len(queue) >= self.max_pending_per_chat:
+                    self.rejected += 1
+                    return False
+                # The chat is busy, its worker will pick this up when it is done.
+                queue.append(update)
+                self.pending += 1
+                return True
+            self.queues[chat_id] = deque()
+            self.pending += 1
+        self.executor.submit(self.__run, chat_id, update)
+        return True
+
+    def __run(self, chat_id, update):
+        with self.lock:
+            self.pending -= 1
+            self.in_flight += 1
+            self.tokens[chat_id] = CancelToken()
+        try:
+            self.handler(update)
+        except Exception:
+            print(f"Failed to handle update for chat {chat_id}! Exception:\n {traceback.format_exc()}")
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                del self.tokens[chat_id]
+                queue = self.queues[chat_id]
+                if queue:
+                    next_update = queue.popleft()
+                else:
+                    del self.queues[chat_id]
+                    next_update = None
+                    if not self.queues:
+                        self.idle.notify_all()
+            # Re-submit instead of looping so a chat with a long backlog doesn't hog a worker.
+            if next_update is not None:
+                self.executor.submit(self.__run, chat_id, next_update)
+
+    def cancel_token(self, chat_id):
+        with self.lock:
+            return self.tokens.get(chat_id)
+
+    def cancel(self, chat_id, keep_partial=False):
+        # Stops the update being handled in the chat and drops the ones waiting after it.
+        # Returns whether something was running and how many updates were dropped.
+        with self.lock:
+            queue = self.queues.get(chat_id)
+            dropped = len(queue) if queue else 0
+            if dropped:
+                queue.clear()
+                self.pending -= dropped
+            token = self.tokens.get(chat_id)
+            if token is not None:
+                token.cancel(keep_partial)
+        return token is not None, dropped
+
+    def queue_depth(self):
+        with self.lock:
+            return self.pending
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.max_workers,
+                "in_flight": self.in_flight,
+                "queue_depth": self.pending,
+                "active_chats": len(self.queues),
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=True):
+        if wait:
+            # Let every chat drain its queue, workers re-submit their follow-up updates.
+            with self.idle:
+                self.idle.wait_for(lambda: not self.queues)
+        self.executor.shutdown(wait=wait)
@@ -1,18 +1,123 @@
 import json
 import base64
+import hashlib
 import openai
 import telebot
+import threading
 import traceback
 from utils import *
+from dispatcher import ChatDispatcher, CancelToken, Cancelled
+from context_store import ContextStore
+from storage import Storage
+from webhook import WebhookServer, webhook_path
+from sharding import ShardRouter
+from coalescer import MessageCoalescer
+from metrics import metrics, current_command, startup, PhaseTimer, MetricsServer
+from streaming import EditBudget, StreamingReply, VoiceReply
+from scheduler import OpenAIScheduler, RateLimitTimeout
+from router import ModelRouter, FALLBACK_ERRORS, ROUTE_FLAGS
+from media_cache import MediaCache
+from transport import PoolStats, openai_http_client, openai_timeout, use_telegram_pool, pools_report
 from io import BytesIO
-from time import sleep
+from time import sleep, perf_counter
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from openai import RateLimitError
-from telebot.types import Message, BotCommand, BotCommandScopeChat
+from telebot.types import Message, Update, BotCommand, BotCommandScopeChat
 
 TELEGRAM_API_KEY = ""
 OPENAI_API_KEY = ""
 
+# Leave WEBHOOK_URL empty to use long polling instead. The server listens on the path of the URL.
+WEBHOOK_URL = ""
+WEBHOOK_SECRET = ""  # Required with a webhook. Only A-Z, a-z, 0-9, _ and - are allowed
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+
+# Number of worker processes chats are spread across, 1 runs everything in this process.
+SHARDS = 1
+
+# Local port of the Prometheus metrics endpoint, shards use the ones after it. 0 disables it.
+METRICS_PORT = 9464
+
+# Once a chat's context is longer than this many tokens, or close to the number of messages kept,
+# its oldest turns are summarized by SUMMARY_ENGINE instead of just being dropped. 0 disables it.
+COMPACT_TOKENS = 0
+SUMMARY_ENGINE = "gpt-4.1-mini"
+
+# Set it (to "gpt-4.1-mini" for example) to send simple requests to FAST_ENGINE and everything
+# else to the main model, see router.ModelRouter. Empty sends every request to the main model.
+FAST_ENGINE = ""
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for your own memory, in the language it is written in. "
+    "Keep names, facts, decisions, preferences and open questions, drop small talk. If it "
+    "starts with an earlier summary, merge it in. Answer with the summary only."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+CONTROL_TOKENS = ("IMAGE_REQUESTED_123", "VOICE_REQUESTED_123", "TEXT_REQUESTED_123")
+
+# Command -> (method, description). Shared by LockwardBot and AsyncLockwardBot, each one
+# implements the methods its own way.
+COMMANDS = {
+    "context": ("get_context", "Gets the current context."),
+    "context_length": ("get_context_length", "Gets the current context length."),
+    "clear_context": ("clear_context", "Clears the current context."),
+    "image": ("generate_image", "Generates an image based on the user's prompt."),
+    "audio": ("generate_voice", "Converts a text input into a voice note"),
+    "cancel": (
+        "cancel_response",
+        "Stops the current response. /cancel keep keeps what was generated in the context.",
+    ),
+}
+
+ADMIN_COMMANDS = {
+    "grant": ("grant_access", "Grants access to a user. (Admin Only) Usage: /grant <username>"),
+    "revoke": ("revoke_access", "Revokes access to a user. (Admin Only) Usage: /revoke <username>"),
+    "list_users": ("list_users", "Lists current allowed users. (Admin Only)"),
+    "token_usage": ("get_token_usage", "Get general token usage by username"),
+    "image_usage": ("get_image_usage", "Get general image usage by username"),
+    "voice_usage": ("get_voice_usage", "Get general voice usage by username"),
+    "queue": ("get_queue_stats", "Get the current queue depth and worker usage. (Admin Only)"),
+    "cache": ("get_cache_stats", "Get the size and hit rate of the media cache. (Admin Only)"),
+    "perf": ("get_perf_stats", "Get how long each stage of answering takes. (Admin Only)"),
+    "routing": ("get_routing_stats", "Get how requests are routed between models. (Admin Only)"),
+}
+
+# Usage kind -> (title, message when there is no usage)
+USAGE_REPORTS = {
+    "tokens": ("Token usage per Username:", "No token usage so far..."),
+    "images": ("Number of images generated per Username:", "No image usage so far..."),
+    "voice": ("Number of voice notes generated per Username:", "No audio usage so far..."),
+}
+
+
+def commands_digest(commands: list):
+    return hashlib.sha256(
+        json.dumps([(c.command, c.description) for c in commands]).encode("utf-8")
+    ).hexdigest()
+
+
+def sent_file_id(message: Message):
+    # file_id of the voice note or photo in a message the bot sent.
+    if message.voice is not None:
+        return message.voice.file_id
+    if message.photo:
+        return message.photo[-1].file_id
+    return None
+
+
+def message_photos(message: Message):
+    # Every photo of a message as a list of PhotoSize lists, one per photo.
+    return getattr(message, "photos", None) or [message.photo]
+
+
+def build_commands(bot, commands: dict):
+    return {
+        cmd: {"func": getattr(bot, method), "desc": desc} for cmd, (method, desc) in commands.items()
+    }
+
 
 class ChatGPT:
     def __init__(
@@ -24,8 +129,17 @@ class ChatGPT:
         tts_voice="alloy",
         model_token_limit=16000,  # Maximum number of tokens the model can handle(Reduced to 16,000 to reduce costs)
         max_tokens=4000,  # Maximun number of tokens in the response (Max cost per response 0.06$)
-        context={},
+        context=None,  # A ContextStore, or a {chat_id: [messages]} dict to import
         context_size=10,
+        trim_policy="keep_pairs",  # How old messages are dropped when the context is too long. See utils.TRIM_POLICIES
+        scheduler: OpenAIScheduler = None,  # Rate limits and retries every OpenAI call
+        media_cache: MediaCache = None,  # Generated audio and images
+        router: ModelRouter = None,  # Picks the model of each completion, model_engine for all if None
+        compact_tokens=0,  # Summarize the oldest turns once the context is longer than this, 0 only trims
+        compact_keep_tokens=None,  # Newest tokens that are never summarized, half of compact_tokens by default
+        summary_engine="gpt-4.1-mini",
+        summary_max_tokens=600,
+        max_connections=16,  # To OpenAI, 8 workers, 4 voice notes being spoken and 2 summaries
     ) -> None:
         self.model_token_limit = model_token_limit
         self.max_tokens = max_tokens
@@ -33,7 +147,11 @@ class ChatGPT:
         self.stt_engine = stt_engine
         self.tts_engine = tts_engine
         self.tts_voice = tts_voice
-        self.context = context
+        if isinstance(context, ContextStore):
+            self.context = context
+        else:
+            self.context = ContextStore(context_size)
+            self.context.import_context(context or {})
         self.perma_context = [
             "You are LockwardGPT, Carlos Fernandez's personal AI",
             "If asked for code you return it in markdown code block format",
@@ -43,114 +161,401 @@ class ChatGPT:
             "You always try to keep your answers as short and concise as possible unless asked otherwise",
         ]
         self.context_size = context_size
+        self.trim_policy = trim_policy
         self.image_size = 1024
-        self.openai_client = openai.OpenAI(api_key=api_key)
-
-    def __trim_messages(self, messages: list, trim_to):
-        trim_to = int(trim_to)
-        res = messages.copy()
-        while True:
-            if len(res) > 2:
-                res.pop(1)
-                if count_tokens_in_messages(res) <= trim_to:
-                    return res
-            else:
-                return res
-
-    def image(self, prompt: str):
-        response = self.openai_client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size=f"{self.image_size}x{self.image_size}",
-            quality="hd",
+        self.image_quality = "hd"
+        self.system_messages = {}
+        self.media_cache = media_cache if media_cache is not None else MediaCache()
+        self.scheduler = scheduler if scheduler is not None else OpenAIScheduler()
+        self.router = router
+        self.openai_pool = PoolStats(metrics, "openai", max_connections)
+        self.openai_client = self.build_openai_client(api_key)
+        self.compact_tokens = compact_tokens
+        self.compact_keep_tokens = (
+            compact_keep_tokens if compact_keep_tokens is not None else compact_tokens // 2
         )
-        return response.data[0].url
-
-    def stt(self, audio_bytes: bytes):
-        audio_file = BytesIO(audio_bytes)
-        transcript = self.openai_client.audio.transcriptions.create(
-            model=self.stt_engine, file=("msg.mp3", audio_file)
+        self.summary_engine = summary_engine
+        self.summary_max_tokens = summary_max_tokens
+        self.compact_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="compact")
+        self.compact_lock = threading.Lock()
+        self.compacting = set()  # chat_ids whose summary is being written
+        self.compactions = 0
+
+    def build_openai_client(self, api_key):
+        # Retries are handled by the scheduler.
+        return openai.OpenAI(
+            api_key=api_key,
+            max_retries=0,
+            timeout=openai_timeout(),
+            http_client=openai_http_client(self.openai_pool),
         )
-        return transcript.text
 
-    def tts(self, text):
-        response = self.openai_client.audio.speech.create(
-            model=self.tts_engine, voice=self.tts_voice, input=text, response_format="mp3"
+    def __trim_messages(self, messages: list, trim_to):
+        with metrics.timer("trim", self.model_engine):
+            return trim_messages(messages, int(trim_to), self.model_engine, self.trim_policy)
+
+    def image_key(self, prompt: str):
+        return self.media_cache.key("image", "dall-e-3", self.image_size, self.image_quality, prompt)
+
+    def image(self, prompt: str, user=None):
+        key = self.image_key(prompt)
+        image = self.media_cache.get(key)
+        if image is None:
+            response = self.scheduler.call(
+                lambda: self.openai_client.images.with_raw_response.generate(
+                    model="dall-e-3",
+                    prompt=prompt,
+                    n=1,
+                    size=f"{self.image_size}x{self.image_size}",
+                    quality=self.image_quality,
+                    response_format="b64_json",
+                ),
+                user,
+                model="dall-e-3",
+            )
+            image = base64.b64decode(response.data[0].b64_json)
+            self.media_cache.put(key, image)
+        return image
+
+    def stt(self, audio_bytes: bytes, user=None):
+        transcript = self.scheduler.call(
+            lambda: self.openai_client.audio.transcriptions.with_raw_response.create(
+                model=self.stt_engine, file=("msg.mp3", BytesIO(audio_bytes))
+            ),
+            user,
+            model=self.stt_engine,
         )
-        return response.read()
+        return transcript.text
 
-    def chat(self, prompt: str, chat_id, image_data=None, talking_to=None):
-        if chat_id not in self.context.keys():
-            self.context[chat_id] = []
-        extra = f"You are talking to {talking_to}" if talking_to else ""
+    def tts_key(self, text: str):
+        return self.media_cache.key("tts", self.tts_engine, self.tts_voice, "mp3", text)
+
+    def tts(self, text, user=None):
+        key = self.tts_key(text)
+        audio = self.media_cache.get(key)
+        if audio is None:
+            response = self.scheduler.call(
+                lambda: self.openai_client.audio.speech.with_raw_response.create(
+                    model=self.tts_engine, voice=self.tts_voice, input=text, response_format="mp3"
+                ),
+                user,
+                model=self.tts_engine,
+            )
+            audio = response.read()
+            self.media_cache.put(key, audio)
+        return audio
+
+    def system_message(self, content):
+        # Reuse the same message so its token count is only computed once.
+        if content not in self.system_messages:
+            self.system_messages[content] = {"role": "system", "content": content}
+        return self.system_messages[content]
+
+    def system_prompt(self, talking_to=None):
+        # The instructions are the same for every user and go first, byte for byte, so OpenAI's
+        # prompt caching can reuse them. Whatever depends on the user comes after them.
+        prompt = [self.system_message(" ".join(self.perma_context))]
+        if talking_to:
+            prompt.append(self.system_message(f"You are talking to {talking_to}"))
+        return prompt
+
+    def build_messages(self, prompt: str, chat_id, image_data=None, talking_to=None):
+        context = self.context.messages(chat_id)
 
         if image_data:
+            # One image part, or a list of them for albums.
+            images = image_data if isinstance(image_data, list) else [image_data]
             messages = (
-                [{"role": "system", "content": f"{' '.join(self.perma_context)} {extra}"}]
-                + self.context[chat_id]
+                self.system_prompt(talking_to)
+                + context
                 + [
                     {
                         "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": image_data},
-                        ],
+                        "content": [{"type": "text", "text": prompt}] + images,
                     }
                 ]
             )
         else:
             messages = (
-                [{"role": "system", "content": f"{' '.join(self.perma_context)} {extra}"}]
-                + self.context[chat_id]
+                self.system_prompt(talking_to)
+                + context
                 + [{"role": "user", "content": prompt}]
             )
 
-        num_tokens = count_tokens_in_messages(messages)
+        with metrics.timer("count_tokens", self.model_engine):
+            num_tokens = count_tokens_in_messages(messages, self.model_engine)
 
         max_response_tokens = self.max_tokens
         max_context_tokens = self.model_token_limit - self.max_tokens
 
         if num_tokens > max_context_tokens:
             print("!! Message too long. Trimming... !!")
-            messages = self.__trim_messages(messages, max_context_tokens)
+            messages, removed_tokens = self.__trim_messages(messages, max_context_tokens)
 
-            new_num_tokens = count_tokens_in_messages(messages)
-            print(f"Old tokens: {num_tokens}. New tokens: {new_num_tokens}")
+            new_num_tokens = num_tokens - removed_tokens
+            print(f"Old tokens: {num_tokens}. New tokens: {new_num_tokens}. Removed: {removed_tokens}")
 
             # If after trimming, the context + the message is still too long, lets remove some tokens from the response to make room.
             if new_num_tokens > max_context_tokens:
                 max_response_tokens = self.model_token_limit - new_num_tokens
                 print(f"Had to reduce response length! Max response tokens: {max_response_tokens}")
 
+        return messages, max_response_tokens
+
+    def remember(self, prompt: str, messages: list, chat_id, response: str, talking_to=None):
+        print(f"{talking_to.split(' ')[0] if talking_to else 'Prompt'}: {prompt}")
+        print(f"ChatGPT: {response}")
+
+        # Images are not kept in the context, only the text that came with them.
+        prompt_message = messages[-1]
+        if not isinstance(prompt_message["content"], str):
+            prompt_message = {"role": "user", "content": prompt}
+
+        # Store each message with its token count so the context is never tokenized again.
+        # Old messages fall out of the context store on their own.
+        response_message = {"role": "assistant", "content": response}
+        count_tokens_in_messages([prompt_message, response_message], self.model_engine)
+        self.context.append(chat_id, prompt_message, response_message)
+        self.maybe_compact(chat_id)
+
+    def maybe_compact(self, chat_id):
+        # The summary is written in the background, the turns it covers are replaced by it once
+        # it is ready. Until then the context is trimmed as usual if it has to.
+        if not self.compact_tokens:
+            return
+        context = self.context.messages(chat_id)
+        # Short turns fill the ring buffer long before they reach compact_tokens, they are
+        # summarized before they would fall out of it.
+        turns = len(context) - (1 if context and context[0]["role"] == "system" else 0)
+        full = turns >= self.context.context_size * 3 // 4
+        if not full and count_tokens_in_messages(context, self.model_engine) <= self.compact_tokens:
+            return
+        with self.compact_lock:
+            if chat_id in self.compacting:
+                return
+            self.compacting.add(chat_id)
+        self.start_compaction(chat_id, context)
+
+    def start_compaction(self, chat_id, context: list):
+        self.compact_executor.submit(self.compact, chat_id, context)
+
+    def compaction(self, context: list):
+        # The oldest turns, everything but the newest compact_keep_tokens worth of them (and at
+        # most half of the ring buffer), and the arguments of the request that summarizes them.
+        # The previous summary is pinned by the trim, so it is never kept as it is, it's merged
+        # into the new one.
+        kept, _ = trim_messages(context, self.compact_keep_tokens, self.model_engine, "keep_pairs")
+        summarized = 1 if context[0]["role"] == "system" else 0
+        cut = len(context) - min(len(kept) - summarized, self.context.context_size // 2)
+        # The trim always keeps the last message, a reply, the kept turns start with a prompt.
+        while cut > summarized and context[cut]["role"] != "user":
+            cut -= 1
+        old = context[:cut]
+        if len(old) - summarized < 2:
+            return None
+        names = {"system": "Earlier summary", "user": "User", "assistant": "Assistant"}
+        transcript = "\n\n".join(
+            f"{names[m['role']]}: {m['content'].removeprefix(SUMMARY_PREFIX)}"
+            for m in old
+            if isinstance(m["content"], str)
+        )
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ]
+        args = {
+            "model": self.summary_engine,
+            "messages": messages,
+            "max_tokens": self.summary_max_tokens,
+            "temperature": 0.2,
+        }
+        estimated_tokens = (
+            count_tokens_in_messages(messages, self.summary_engine) + self.summary_max_tokens
+        )
+        return old, args, estimated_tokens
+
+    def finish_compaction(self, chat_id, old: list, completion, estimated_tokens):
+        self.scheduler.settle(estimated_tokens, completion.usage.total_tokens)
+        summary = (completion.choices[0].message.content or "").strip()
+        if not summary:
+            return
+        message = {"role": "system", "content": f"{SUMMARY_PREFIX}{summary}"}
+        count_tokens_in_messages([message], self.model_engine)
+        # A /clear_context or a chat that moved on while the summary was written wins.
+        if self.context.compact(chat_id, old, message):
+            self.compactions += 1
+            print(f"Summarized {len(old)} messages of chat {chat_id}")
+
+    def end_compaction(self, chat_id):
+        with self.compact_lock:
+            self.compacting.discard(chat_id)
+
+    def compact(self, chat_id, context: list):
+        try:
+            plan = self.compaction(context)
+            if plan is not None:
+                old, args, estimated_tokens = plan
+                completion = self.scheduler.call(
+                    lambda: self.openai_client.chat.completions.with_raw_response.create(**args),
+                    chat_id,
+                    estimated_tokens,
+                    self.summary_engine,
+                )
+                self.finish_compaction(chat_id, old, completion, estimated_tokens)
+        except Exception:
+            print(f"Failed to summarize chat {chat_id}! Exception:\n {traceback.format_exc()}")
+        finally:
+            self.end_compaction(chat_id)
+
+    def pick_model(self, prompt: str, image_data=None, flag=None):
+        if self.router is None:
+            return self.model_engine
+        prompt_tokens = count_text_tokens(prompt or "", self.model_engine)
+        return self.router.route(prompt_tokens, bool(image_data), flag)
+
+    def completion_models(self, model):
+        # The model to ask first and, when routing, the one to fall back to.
+        if self.router is None:
+            return [model]
+        return [model, self.router.other(model)]
+
+    def record_completion(self, model, seconds, failed=False):
+        if self.router is not None:
+            self.router.record(model, seconds, failed)
+
+    def create_completion(self, args: dict, chat_id, estimated_tokens):
+        # Returns the completion (or the stream) and the model that answered. A model that is
+        # rate limited or times out isn't retried when there is another one to ask.
+        models = self.completion_models(args["model"])
+        for i, model in enumerate(models):
+            request = {**args, "model": model}
+            last = i == len(models) - 1
+            try:
+                completion = self.scheduler.call(
+                    lambda: self.openai_client.chat.completions.with_raw_response.create(**request),
+                    chat_id,
+                    estimated_tokens,
+                    model,
+                    max_retries=None if last else 0,
+                    on_response=lambda seconds: self.record_completion(model, seconds),
+                )
+            except Exception as e:
+                self.record_completion(model, 0.0, failed=True)
+                if last or not isinstance(e, FALLBACK_ERRORS):
+                    raise e
+                print(f"!! {model} failed ({type(e).__name__}). Falling back to {models[i + 1]} !!")
+                # The next model is charged for the request, not both of them.
+                self.scheduler.refund(estimated_tokens)
+                self.router.fell_back()
+                continue
+            return completion, model
+
+    def completion_args(self, messages: list, max_response_tokens, stream=False, model=None):
+        args = {
+            "model": model or self.model_engine,
+            "messages": api_messages(messages),
+            "max_tokens": max_response_tokens,
+            "temperature": 0.6,
+            "frequency_penalty": 0.1,
+            "presence_penalty": 0.1,
+        }
+        if stream:
+            # The last chunk carries the usage and no choices.
+            args["stream"] = True
+            args["stream_options"] = {"include_usage": True}
+        return args
+
+    def stop_if_cancelled(
+        self, cancel: CancelToken, prompt, messages, chat_id, response="", usage=0, talking_to=None
+    ):
+        if cancel is None or not cancel.is_set():
+            return
+        # Partial responses are only remembered if the user asked for it with /cancel keep.
+        if cancel.keep_partial and response:
+            self.remember(prompt, messages, chat_id, response, talking_to)
+        raise Cancelled(response, usage)
+
+    def chat(
+        self, prompt: str, chat_id, image_data=None, talking_to=None, cancel=None, flag=None
+    ):
+        # flag is "fast" or "strong" when the user asked for a model, see router.ModelRouter.
+        messages, max_response_tokens = self.build_messages(prompt, chat_id, image_data, talking_to)
+        self.stop_if_cancelled(cancel, prompt, messages, chat_id)
+
+        model = self.pick_model(prompt, image_data, flag)
+        args = self.completion_args(messages, max_response_tokens, model=model)
+        # The rate limit counts max_tokens as used until the response says otherwise.
+        estimated_tokens = count_tokens_in_messages(messages, self.model_engine) + max_response_tokens
+
         for _ in range(3):
-            completion = self.openai_client.chat.completions.create(
-                model=self.model_engine,
-                messages=messages,
-                max_tokens=max_response_tokens,
-                temperature=0.6,
-                frequency_penalty=0.1,
-                presence_penalty=0.1,
-                timeout=60,
-            )
+            completion, _ = self.create_completion(args, chat_id, estimated_tokens)
             response = completion.choices[0].message
             usage = completion.usage.total_tokens
+            cached = cached_tokens(completion.usage)
+            self.scheduler.settle(estimated_tokens, usage)
             if response:
                 break
             sleep(0.5)
 
+        self.stop_if_cancelled(
+            cancel, prompt, messages, chat_id, response.content, usage, talking_to
+        )
         if response:
-            print(f"{talking_to.split(' ')[0] if talking_to else 'Prompt'}: {prompt}")
-            print(f"ChatGPT: {response.content}")
+            self.remember(prompt, messages, chat_id, response.content, talking_to)
 
-            # Remove old context
-            for _ in range(min(len(self.context[chat_id]) - (self.context_size - 2), 0)):
-                self.context[chat_id].pop(0)
+        return response.content, usage, cached
 
-            self.context[chat_id].append({"role": "user", "content": prompt})
-            self.context[chat_id].append({"role": "assistant", "content": response.content})
+    def chat_stream(
+        self,
+        prompt: str,
+        chat_id,
+        on_delta,
+        image_data=None,
+        talking_to=None,
+        cancel=None,
+        flag=None,
+    ):
+        # Same as chat, but on_delta is called with the response so far as soon as tokens arrive.
+        messages, max_response_tokens = self.build_messages(prompt, chat_id, image_data, talking_to)
+        self.stop_if_cancelled(cancel, prompt, messages, chat_id)
+
+        model = self.pick_model(prompt, image_data, flag)
+        args = self.completion_args(messages, max_response_tokens, stream=True, model=model)
+        prompt_tokens = count_tokens_in_messages(messages, self.model_engine)
+        estimated_tokens = prompt_tokens + max_response_tokens
+
+        start = perf_counter()
+        stream, model = self.create_completion(args, chat_id, estimated_tokens)
+        response = ""
+        usage = 0
+        cached = 0
+        first_token = True
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                # Closing the connection stops the generation. The usage chunk never comes,
+                # this is close enough.
+                stream.close()
+                usage = prompt_tokens + count_text_tokens(response, self.model_engine)
+                self.scheduler.settle(estimated_tokens, usage)
+                self.stop_if_cancelled(
+                    cancel, prompt, messages, chat_id, response, usage, talking_to
+                )
+            if chunk.usage:
+                usage = chunk.usage.total_tokens
+                cached = cached_tokens(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token:
+                    metrics.observe("first_token", perf_counter() - start, model)
+                    first_token = False
+                response += chunk.choices[0].delta.content
+                on_delta(response)
+        metrics.observe("stream", perf_counter() - start, model)
+        self.scheduler.settle(estimated_tokens, usage)
+
+        if response:
+            self.remember(prompt, messages, chat_id, response, talking_to)
 
-        return response.content, usage
+        return response, usage, cached
 
 
 class CustomMessage:
@@ -160,65 +565,93 @@ class CustomMessage:
         self.from_user = from_user
 
 
+class MergedMessage(CustomMessage):
+    # Messages sent in a burst (or an album) handled as a single user turn.
+    def __init__(self, messages: list):
+        texts = [m.text if m.content_type == "text" else m.caption for m in messages]
+        super().__init__("\n".join(t for t in texts if t), messages[0].chat, messages[0].from_user)
+        self.photos = [m.photo for m in messages if m.content_type == "photo"]
+        self.content_type = "photo" if self.photos else "text"
+        self.caption = self.text
+        self.message_id = messages[-1].message_id
+
+
 class LockwardBot:
-    def __init__(self, chatgpt: ChatGPT, telegram_api_key, user_path="users.json") -> None:
-        self.bot = telebot.TeleBot(telegram_api_key)
-        self.bot.register_message_handler(self.handle_msg)
+    def __init__(
+        self,
+        chatgpt: ChatGPT,
+        telegram_api_key,
+        storage: Storage = None,
+        max_workers=8,  # Number of chats that can be handled at the same time
+        max_pending=200,  # Maximum number of updates waiting for a worker
+        max_pending_per_chat=20,
+        stream_responses=True,  # Show the response while it is being generated
+        edit_interval=1.0,  # Minimum seconds between edits of a streaming response
+        pipeline_voice=True,  # Speak answers to voice notes sentence by sentence while they stream
+        coalesce_window=0.0,  # Seconds to wait for more messages of a burst before answering them
+        media_group_window=0.5,  # Seconds to wait for the rest of an album
+    ) -> None:
+        # Updates are handed to the dispatcher, so telebot doesn't need its own worker threads.
+        # Workers, voice notes being spoken and long polling share one pool of connections.
+        tts_workers = 4
+        self.telegram_pool = PoolStats(metrics, "telegram", max_workers + tts_workers + 1)
+        use_telegram_pool(self.telegram_pool)
+        self.bot = telebot.TeleBot(telegram_api_key, threaded=False)
+        self.bot.register_message_handler(
+            self.enqueue_msg, content_types=["text", "photo", "voice"]
+        )
+        self.dispatcher = ChatDispatcher(
+            self.handle_msg,
+            max_workers=max_workers,
+            max_pending=max_pending,
+            max_pending_per_chat=max_pending_per_chat,
+        )
+        self.stream_responses = stream_responses
+        self.edit_interval = edit_interval
+        self.edit_budget = EditBudget()
+        self.pipeline_voice = pipeline_voice
+        self.tts_executor = ThreadPoolExecutor(max_workers=tts_workers, thread_name_prefix="tts")
+        self.coalescer = MessageCoalescer(
+            self.submit_batch, window=coalesce_window, media_group_window=media_group_window
+        )
+        metrics.gauge("queue_depth", self.dispatcher.queue_depth)
+        metrics.gauge("in_flight", lambda: self.dispatcher.stats()["in_flight"])
         self.callback = {}
         self.chatgpt = chatgpt
-        self.user_path = user_path
-        self.token_usage = {}
-        self.image_usage = {}
-        self.voice_usage = {}
-        self.commands = {
-            "context": {"func": self.get_context, "desc": "Gets the current context."},
-            "context_length": {
-                "func": self.get_context_length,
-                "desc": "Gets the current context length.",
-            },
-            "clear_context": {"func": self.clear_context, "desc": "Clears the current context."},
-            "image": {
-                "func": self.generate_image,
-                "desc": "Generates an image based on the user's prompt.",
-            },
-            "audio": {
-                "func": self.generate_voice,
-                "desc": "Converts a text input into a voice note",
-            },
-        }
-
-        self.admin_commands = {
-            "grant": {
-                "func": self.grant_access,
-                "desc": "Grants access to a user. (Admin Only) Usage: /grant <username>",
-            },
-            "revoke": {
-                "func": self.revoke_access,
-                "desc": "Revokes access to a user. (Admin Only) Usage: /revoke <username>",
-            },
-            "list_users": {
-                "func": self.list_users,
-                "desc": "Lists current allowed users. (Admin Only)",
-            },
-            "token_usage": {
-                "func": self.get_token_usage,
-                "desc": "Get general token usage by username",
-            },
-            "image_usage": {
-                "func": self.get_image_usage,
-                "desc": "Get general image usage by username",
-            },
-            "voice_usage": {
-                "func": self.get_voice_usage,
-                "desc": "Get general voice usage by username",
-            },
-        }
+        self.storage = storage if storage is not None else Storage()
+        self.setup_commands()
+        self.polling_ready = False
+        self.webhook_set = None
+        self.starts = 0
+
+    def commands_key(self, scope=None):
+        # Settings key remembering what the commands of the bot (in a chat) were set to.
+        chat = scope.chat_id if scope is not None else "all"
+        return f"commands:{self.bot.token.split(':')[0]}:{chat}"
+
+    def set_commands(self, commands: list, scope=None):
+        # Every call is a round trip to Telegram, it's skipped when the commands are the same
+        # as the last time they were set, also by an earlier run.
+        key = self.commands_key(scope)
+        digest = commands_digest(commands)
+        if self.storage.get_setting(key) == digest:
+            return False
+        self.bot.set_my_commands(commands, scope=scope)
+        self.storage.set_setting(key, digest)
+        return True
+
+    def publish_commands(self):
+        with startup.phase("commands"):
+            self.set_commands(self.command_list)
+
+    def setup_commands(self):
+        self.commands = build_commands(self, COMMANDS)
+        self.admin_commands = build_commands(self, ADMIN_COMMANDS)
 
         self.command_list = []
         for key, val in self.commands.items():
             self.command_list.append(BotCommand(f"/{key}", val.get("desc", "")))
 
-        self.bot.set_my_commands(self.command_list)
         self.admins = ["carloslockward"]
 
         self.admin_command_list = []
@@ -227,81 +660,58 @@ class LockwardBot:
 
         self.init_admin_cmds = False
 
-        if not Path(self.user_path).exists():
-            Path(self.user_path).touch()
-            self.users = {"users": ["carloslockward"]}
-        else:
-            self.users = self.get_users()
+        if not self.storage.get_users():
+            self.storage.add_user("carloslockward")
 
     def __do_nothing(self, message):
         pass
 
-    def save_users(self):
-        with Path(self.user_path).open("w") as j:
-            json.dump(self.users, j)
-
     def is_user_valid(self, username):
         # TODO: Actually validate the username using regex or something else.
         return username
 
-    def get_context(self, message: Message):
-        chat_id = message.chat.id
-
-        context = self.chatgpt.context.get(str(chat_id))
+    def context_report(self, chat_id, full_name):
+        context = self.chatgpt.context.messages(str(chat_id))
 
-        if context is None or len(context) == 0:
-            self.send_message_bot(chat_id, f"Context is currently empty")
-            return
+        if len(context) == 0:
+            return f"Context is currently empty"
 
         full_context = ""
         for msg in context:
             full_context += (
                 "\n"
-                + ("LockwardGPT" if msg["role"] == "assistant" else message.from_user.full_name)
+                + {"assistant": "LockwardGPT", "system": "Summary"}.get(msg["role"], full_name)
                 + ": "
                 + msg["content"]
             )
 
-        self.send_message_bot(chat_id, f"Context: {full_context}")
+        return f"Context: {full_context}"
 
-    def __split_string(self, string: str, max_length=4090) -> list[str]:
-        return [string[i : i + max_length] for i in range(0, len(string), max_length)]
+    def get_context(self, message: Message):
+        chat_id = message.chat.id
+        self.send_message_bot(chat_id, self.context_report(chat_id, message.from_user.full_name))
 
     def send_message_bot(self, *args, **kwargs):
+        # Long texts are sent in parts. Each part is retried on its own, so parts that were
+        # already sent aren't sent again.
+        args = list(args)
+        text = kwargs["text"] if "text" in kwargs else args[1]
+        last = None
+        with metrics.timer("send_message"):
+            for t in split_message(text, parse_mode=kwargs.get("parse_mode")):
+                if "text" in kwargs:
+                    kwargs["text"] = t
+                else:
+                    args[1] = t
+                last = self.send_part(*args, **kwargs)
+        return last
+
+    def send_part(self, *args, **kwargs):
         ex = None
         # If message fails, retry 4 more times
         for _ in range(5):
             try:
-                new_text = ""
-                if len(args) >= 2:
-                    if len(args[1]) > 4096:
-                        new_text = args[1]
-                elif "text" in kwargs.keys():
-                    if len(kwargs["text"]) > 4096:
-                        new_text = kwargs["text"]
-
-                if new_text:
-                    start_block = False
-                    last = None
-                    for t in self.__split_string(new_text):
-                        if "```" in new_text:
-                            if start_block:
-                                t = "```" + t
-                                start_block = False
-                            if t.count("```") % 2 != 0:
-                                t += "```"
-                                start_block = True
-                        new_args = list(args)
-                        if "text" in kwargs.keys():
-                            kwargs["text"] = t
-                        else:
-                            new_args[1] = t
-                        last = self.bot.send_message(*new_args, **kwargs)
-                    return last
-
-                else:
-                    return self.bot.send_message(*args, **kwargs)
-
+                return self.bot.send_message(*args, **kwargs)
             except Exception as e:
                 if "can't parse" in str(e):
                     raise e
@@ -313,108 +723,177 @@ class LockwardBot:
         if ex is not None:
             raise ex
 
-    def grant_access(self, message: Message):
-        self.users = self.get_users()
-        msg = message.text
-        chat_id = message.chat.id
-        users_list = msg.replace("/grant", "").strip().split(" ")
+    def grant_users(self, text: str):
+        users_list = text.replace("/grant", "").strip().split(" ")
+        replies = []
         save = False
         for user in users_list:
             if self.is_user_valid(user):
                 clean_user = user.replace("@", "").strip()
-                if clean_user not in self.users["users"]:
-                    self.users["users"].append(clean_user)
+                if not self.storage.has_user(clean_user):
+                    self.storage.add_user(clean_user)
                     save = True
                 else:
-                    self.send_message_bot(chat_id, f"User @{clean_user} already had access!")
+                    replies.append(f"User @{clean_user} already had access!")
         if save:
-            self.save_users()
             if len(users_list) > 1:
-                self.send_message_bot(chat_id, f"Granted access to {len(users_list)} users")
+                replies.append(f"Granted access to {len(users_list)} users")
             else:
-                self.send_message_bot(chat_id, f"Granted access to user @{clean_user}")
+                replies.append(f"Granted access to user @{clean_user}")
+        return replies
 
-    def revoke_access(self, message: Message):
-        self.users = self.get_users()
-        msg = message.text
-        chat_id = message.chat.id
+    def grant_access(self, message: Message):
+        for reply in self.grant_users(message.text):
+            self.send_message_bot(message.chat.id, reply)
 
-        users_list = msg.replace("/revoke", "").strip().split(" ")
+    def revoke_users(self, text: str):
+        users_list = text.replace("/revoke", "").strip().split(" ")
         save = False
         for user in users_list:
             if self.is_user_valid(user):
                 clean_user = user.replace("@", "").strip()
-                if clean_user in self.users["users"]:
-                    self.users["users"].remove(clean_user)
+                if self.storage.has_user(clean_user):
+                    self.storage.remove_user(clean_user)
                     save = True
         if save:
-            self.save_users()
-            self.send_message_bot(chat_id, f"Revoked access to user @{clean_user}")
+            return [f"Revoked access to user @{clean_user}"]
+        return []
 
-    def list_users(self, message: Message):
-        self.users = self.get_users()
-        chat_id = message.chat.id
+    def revoke_access(self, message: Message):
+        for reply in self.revoke_users(message.text):
+            self.send_message_bot(message.chat.id, reply)
 
+    def users_report(self):
         new_line = "\n"
+        return f"Current users are:\n\n{new_line.join(self.storage.get_users())}"
 
-        self.send_message_bot(
-            chat_id, f"Current users are:\n\n{new_line.join(self.users['users'])}"
-        )
+    def list_users(self, message: Message):
+        self.send_message_bot(message.chat.id, self.users_report())
 
     def clear_context(self, message: Message):
         chat_id = message.chat.id
 
-        if str(chat_id) in self.chatgpt.context.keys():
-            self.chatgpt.context[str(chat_id)] = []
+        self.chatgpt.context.clear(str(chat_id))
 
         self.send_message_bot(chat_id, "Context has been cleared!")
 
-    def get_context_length(self, message: Message):
-        chat_id = message.chat.id
+    def context_length_report(self, chat_id):
         num_tokens = 0
-        if str(chat_id) in self.chatgpt.context.keys():
-            num_tokens = count_tokens_in_messages(self.chatgpt.context[str(chat_id)])
+        context = self.chatgpt.context.messages(str(chat_id))
+        if context:
+            num_tokens = count_tokens_in_messages(context, self.chatgpt.model_engine)
 
-        self.send_message_bot(chat_id, f"Your context is {num_tokens} tokens long.")
+        return f"Your context is {num_tokens} tokens long."
+
+    def get_context_length(self, message: Message):
+        self.send_message_bot(message.chat.id, self.context_length_report(message.chat.id))
+
+    def usage_report(self, kind):
+        title, empty = USAGE_REPORTS[kind]
+        usage = self.storage.get_usage(kind)
+        # Prompt tokens served from OpenAI's prompt cache, part of the token usage.
+        cached = self.storage.get_usage("cached_tokens") if kind == "tokens" else {}
+        if len(usage) > 0:
+            res = f"{title}\n"
+            for username, amount in sorted(usage.items(), key=lambda item: item[1], reverse=True):
+                res += f"@{username}: {amount}"
+                if cached.get(username):
+                    res += f" ({cached[username]} cached)"
+                res += "\n"
+            return res.strip()
+        return empty
 
     def get_token_usage(self, message: Message):
-        chat_id = message.chat.id
-        if len(self.token_usage) > 0:
-            res = "Token usage per Username:\n"
-            for username, num_tokens in sorted(
-                self.token_usage.items(), key=lambda item: item[1], reverse=True
-            ):
-                res += f"@{username}: {num_tokens}\n"
-
-            self.send_message_bot(chat_id, res.strip())
-        else:
-            self.send_message_bot(chat_id, "No token usage so far...")
+        self.send_message_bot(message.chat.id, self.usage_report("tokens"))
 
     def get_image_usage(self, message: Message):
-        chat_id = message.chat.id
-        if len(self.image_usage) > 0:
-            res = "Number of images generated per Username:\n"
-            for username, num_images in sorted(
-                self.image_usage.items(), key=lambda item: item[1], reverse=True
-            ):
-                res += f"@{username}: {num_images}\n"
-
-            self.send_message_bot(chat_id, res.strip())
-        else:
-            self.send_message_bot(chat_id, "No image usage so far...")
+        self.send_message_bot(message.chat.id, self.usage_report("images"))
 
     def get_voice_usage(self, message: Message):
-        chat_id = message.chat.id
-        if len(self.voice_usage) > 0:
-            res = "Number of voice notes generated per Username:\n"
-            for username, num_audios in sorted(
-                self.voice_usage.items(), key=lambda item: item[1], reverse=True
-            ):
-                res += f"@{username}: {num_audios}\n"
-
-            self.send_message_bot(chat_id, res.strip())
-        else:
-            self.send_message_bot(chat_id, "No audio usage so far...")
+        self.send_message_bot(message.chat.id, self.usage_report("voice"))
+
+    def coalescer_report(self):
+        stats = self.coalescer.stats()
+        return (
+            f"Chats waiting for more messages: {stats['waiting_chats']}\n"
+            f"Messages merged into an earlier one: {stats['coalesced']}"
+        )
+
+    def scheduler_report(self):
+        stats = self.chatgpt.scheduler.stats()
+        return (
+            f"Waiting for OpenAI rate limit: {stats['waiting']}\n"
+            f"Requests/tokens available: {stats['requests_available']}/{stats['tokens_available']}\n"
+            f"Retries: {stats['retries']} (rate limited {stats['rate_limited']} times)"
+        )
+
+    def queue_report(self):
+        stats = self.dispatcher.stats()
+        return (
+            f"Queue depth: {stats['queue_depth']}\n"
+            f"In flight: {stats['in_flight']}/{stats['workers']} workers\n"
+            f"Active chats: {stats['active_chats']}\n"
+            f"Rejected updates: {stats['rejected']}\n"
+            f"{self.coalescer_report()}\n"
+            f"{self.scheduler_report()}"
+        )
+
+    def get_queue_stats(self, message: Message):
+        self.send_message_bot(message.chat.id, self.queue_report())
+
+    def cache_report(self):
+        stats = self.chatgpt.media_cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups else 0
+        return (
+            f"Media cache: {stats['entries']} files, "
+            f"{stats['bytes'] / 1e6:.1f}/{stats['max_bytes'] / 1e6:.0f} MB\n"
+            f"Hits: {stats['hits']}, misses: {stats['misses']} ({hit_rate:.0%} hit rate)\n"
+            f"Re-sent by file_id: {stats['file_id_hits']}"
+        )
+
+    def get_cache_stats(self, message: Message):
+        self.send_message_bot(message.chat.id, self.cache_report())
+
+    def perf_report(self):
+        summary = metrics.summary()
+        if not summary:
+            return "No measurements so far..."
+        lines = ["Latency per stage (p50 / p95 / max, count):"]
+        for (stage, model), histogram in sorted(summary.items()):
+            name = f"{stage} ({model})" if model else stage
+            lines.append(
+                f"{name}: {histogram.quantile(0.5):.3f}s / {histogram.quantile(0.95):.3f}s / "
+                f"{histogram.max:.3f}s, {histogram.count}"
+            )
+        if startup.phases:
+            lines.append(f"Startup: {startup.report()}")
+        lines.append(pools_report(self.chatgpt.openai_pool, self.telegram_pool))
+        return "\n".join(lines)
+
+    def get_perf_stats(self, message: Message):
+        self.send_message_bot(message.chat.id, self.perf_report())
+
+    def routing_report(self):
+        router = self.chatgpt.router
+        if router is None:
+            return f"Every request goes to {self.chatgpt.model_engine}."
+        stats = router.stats()
+        lines = ["Models (recent requests, p95, errors, health):"]
+        for model, s in stats["models"].items():
+            lines.append(
+                f"{model}: {s['requests']}, {s['p95']:.2f}s, {s['error_rate']:.0%}, {s['health']}"
+            )
+        lines.append(f"Fallbacks: {stats['fallbacks']}")
+        if stats["decisions"]:
+            lines.append("Routed (model, reason: count):")
+            decisions = sorted(stats["decisions"].items(), key=lambda item: item[1], reverse=True)
+            for (model, reason), count in decisions:
+                lines.append(f"{model}, {reason}: {count}")
+        return "\n".join(lines)
+
+    def get_routing_stats(self, message: Message):
+        self.send_message_bot(message.chat.id, self.routing_report())
 
     def generate_voice(self, message: Message):
         msg = message.text
@@ -425,8 +904,14 @@ class LockwardBot:
 
         if msg:
             self.bot.send_chat_action(chat_id=chat_id, action="upload_voice")
+            sent = None
             try:
-                audio_bytes = self.chatgpt.tts(msg)
+                sent = self.send_media(
+                    self.bot.send_voice,
+                    chat_id,
+                    self.chatgpt.tts_key(msg),
+                    lambda: self.chatgpt.tts(msg, str(chat_id)),
+                )
             except Exception as e:
                 if "safety system" in str(e) or "content filters" in str(e):
                     self.send_message_bot(
@@ -455,15 +940,12 @@ class LockwardBot:
                         )
                         raise e
 
-            if audio_bytes:
-                if username not in self.voice_usage.keys():
-                    self.voice_usage[username] = 0
-                self.voice_usage[username] += 1
-                self.bot.send_voice(chat_id, audio_bytes)
+            if sent:
+                self.storage.add_usage("voice", username)
         else:
             self.send_message_bot(
                 chat_id,
-                "You must provide a prompt\. Usage:\n `/audio <prompt>`",
+                "You must provide a prompt\\. Usage:\n `/audio <prompt>`",
                 parse_mode="MarkdownV2",
             )
 
@@ -476,8 +958,14 @@ class LockwardBot:
 
         if msg:
             self.bot.send_chat_action(chat_id=chat_id, action="upload_photo")
+            sent = None
             try:
-                image_url = self.chatgpt.image(msg)
+                sent = self.send_media(
+                    self.bot.send_photo,
+                    chat_id,
+                    self.chatgpt.image_key(msg),
+                    lambda: self.chatgpt.image(msg, str(chat_id)),
+                )
                 print(f"Image Generated! Prompt: '{msg}'")
             except Exception as e:
                 if "safety system" in str(e) or "content filters" in str(e):
@@ -506,26 +994,34 @@ class LockwardBot:
                             f"An error has occurred. Try clearing the context and try again. If the issue persists contact @carloslockward",
                         )
                         raise e
-            if image_url:
-                if username not in self.image_usage.keys():
-                    self.image_usage[username] = 0
-                self.image_usage[username] += 1
-                self.bot.send_photo(chat_id, photo=image_url)
+            if sent:
+                self.storage.add_usage("images", username)
         else:
             self.send_message_bot(
                 chat_id,
-                "You must provide a prompt\. Usage:\n `/image <prompt>`",
+                "You must provide a prompt\\. Usage:\n `/image <prompt>`",
                 parse_mode="MarkdownV2",
             )
 
-    def get_users(self):
-        users = {"users": ["carloslockward"]}
-        try:
-            with Path(self.user_path).open("r") as uf:
-                users = json.load(uf)
-        except:
-            pass
-        return users
+    def send_media(self, send, chat_id, key, generate):
+        # Sends a generated voice note or photo. If it was sent before Telegram still has it,
+        # it is re-sent by file_id and nothing is generated or uploaded.
+        cache = self.chatgpt.media_cache
+        file_id = cache.file_id(key)
+        if file_id is not None:
+            try:
+                return send(chat_id, file_id)
+            except Exception as e:
+                print(f"!! Couldn't re-send cached file, uploading it again: {e} !!")
+                cache.forget_file_id(key)
+        media = generate()
+        if not media or self.is_cancelled(chat_id):
+            # Generating can't be stopped half way, but a cancelled result isn't sent.
+            return None
+        sent = send(chat_id, media)
+        if sent_file_id(sent):
+            cache.set_file_id(key, sent_file_id(sent))
+        return sent
 
     def command_not_found(self, message: Message):
         msg = message.text.strip()
@@ -551,7 +1047,7 @@ class LockwardBot:
             # Handle generic messages
             return self.chat
         elif message.content_type == "photo":
-            # TODO: See if there is a neat way of supporting multiple images.
+            # Albums and bursts come merged by the coalescer, see MergedMessage.
             return self.chat
         elif message.content_type == "voice":
             return self.chat
@@ -568,39 +1064,81 @@ class LockwardBot:
         chat_id = message.chat.id
         username = message.from_user.username
 
-        # TODO: This only lasts 5 seconds, should find a way of making it last as long as the promt completion
+        # This only lasts 5 seconds, streamed responses replace it with a placeholder message.
         self.bot.send_chat_action(chat_id=chat_id, action="typing")
+        reply = None
+        voice = None
+        cancel = self.cancel_token(chat_id)
         try:
             image_data = None
             if message.content_type == "photo":
-                detail = "low"
-                if "-h" in msg or "--high" in msg:
-                    detail = "high"
-                    msg = msg.replace("--high", "").replace("-h", "").strip()
-                # Download file and ensure is jpeg!
-                file = self.bot.get_file(message.photo[-1].file_id)
-                downloaded_file = ensure_jpeg(self.bot.download_file(file.file_path))
-                base64_image = base64.b64encode(downloaded_file).decode("utf-8")
-                image_data = {"url": f"data:image/jpeg;base64,{base64_image}", "detail": detail}
+                msg, detail = self.photo_detail(msg)
+                image_data = [
+                    self.download_photo(photo, detail) for photo in message_photos(message)
+                ]
             elif message.content_type == "voice":
-                file = self.bot.get_file(message.voice.file_id)
-                mp3_voice_note = self.bot.download_file(file.file_path)
-                msg = self.chatgpt.stt(mp3_voice_note)
+                mp3_voice_note = self.download(message.voice.file_id)
+                msg = self.chatgpt.stt(mp3_voice_note, str(chat_id))
 
-            response, usage = self.chatgpt.chat(
-                msg, str(chat_id), image_data, message.from_user.full_name
-            )
+            msg, flag = self.model_flag(msg)
             if message.content_type == "voice":
-                if (
-                    not response.startswith("VOICE_REQUESTED_123")
-                    and not response.startswith("IMAGE_REQUESTED_123")
-                    and not response.startswith("TEXT_REQUESTED_123")
-                ):
-                    response = "VOICE_REQUESTED_123: " + response
-            if username not in self.token_usage.keys():
-                self.token_usage[username] = 0
-            self.token_usage[username] += usage
-        except RateLimitError as rle:
+                # It is answered with a short voice note, the fast model is enough.
+                flag = "fast"
+
+            if message.content_type == "voice" and self.pipeline_voice:
+                self.bot.send_chat_action(chat_id=chat_id, action="record_voice")
+                voice = VoiceReply(
+                    self.bot,
+                    chat_id,
+                    lambda text: self.chatgpt.tts(text, str(chat_id)),
+                    self.tts_executor,
+                )
+                response, usage, cached = self.chatgpt.chat_stream(
+                    msg,
+                    str(chat_id),
+                    lambda text: voice.update(self.voice_text(text)),
+                    image_data,
+                    message.from_user.full_name,
+                    cancel,
+                    flag,
+                )
+            elif self.stream_responses and message.content_type != "voice":
+                reply = StreamingReply(self.bot, chat_id, self.edit_budget, self.edit_interval)
+                reply.start()
+                response, usage, cached = self.chatgpt.chat_stream(
+                    msg,
+                    str(chat_id),
+                    lambda text: reply.update(self.stream_text(text)),
+                    image_data,
+                    message.from_user.full_name,
+                    cancel,
+                    flag,
+                )
+            else:
+                response, usage, cached = self.chatgpt.chat(
+                    msg, str(chat_id), image_data, message.from_user.full_name, cancel, flag
+                )
+            if message.content_type == "voice":
+                response = self.voice_response(response)
+            self.storage.add_usage("tokens", username, usage)
+            self.storage.add_usage("cached_tokens", username, cached)
+            if voice is not None and self.voice_text(response):
+                # Most of it has been spoken already, this sends whatever is left.
+                voice.finish(self.voice_text(response))
+                self.storage.add_usage("voice", username)
+                return
+        except Cancelled as c:
+            if voice is not None:
+                voice.discard()
+            if reply is not None:
+                self.cancel_reply(reply, c.response)
+            self.storage.add_usage("tokens", username, c.usage)
+            return
+        except (RateLimitError, RateLimitTimeout) as rle:
+            if reply is not None:
+                reply.discard()
+            if voice is not None:
+                voice.discard()
             exception_text = traceback.format_exc()
             if message.from_user.username in self.admins:
                 self.send_message_bot(
@@ -619,6 +1157,10 @@ class LockwardBot:
                     )
             return
         except Exception as e:
+            if reply is not None:
+                reply.discard()
+            if voice is not None:
+                voice.discard()
             if message.from_user.username in self.admins:
                 try:
                     self.send_message_bot(
@@ -644,6 +1186,8 @@ class LockwardBot:
                 response = response.replace("TEXT_REQUESTED_123", "").strip(":").strip()
             # If we need to generate an image!
             if response.startswith("IMAGE_REQUESTED_123"):
+                if reply is not None:
+                    reply.discard()
                 image_prompt = response.replace("IMAGE_REQUESTED_123", "").strip(":").strip()
                 self.generate_image(
                     CustomMessage(
@@ -654,6 +1198,8 @@ class LockwardBot:
                 )
                 self.send_message_bot(chat_id, f'"{image_prompt}"')
             elif response.startswith("VOICE_REQUESTED_123"):
+                if reply is not None:
+                    reply.discard()
                 audio_prompt = response.replace("VOICE_REQUESTED_123", "").strip(":").strip()
                 self.generate_voice(
                     CustomMessage(
@@ -664,73 +1210,341 @@ class LockwardBot:
                 )
             else:
                 # Otherwise send ChatGPT's response to the user!
-                try:
-                    self.send_message_bot(
-                        chat_id,
-                        escape_markdown(response),
-                        parse_mode="MarkdownV2",
-                    )
-                except Exception as e:
-                    if "can't parse" in str(e):
-                        try:
-                            print("!! Couldn't parse Markdown V2 !!")
-                            self.send_message_bot(chat_id, response, parse_mode="Markdown")
-                        except Exception as e2:
-                            if "can't parse" in str(e2):
-                                print("!! Couldn't parse Markdown !!")
-                                self.send_message_bot(chat_id, response)
-                            else:
-                                raise e2
-                    else:
-                        raise e
+                self.send_response(chat_id, response, reply)
+        elif reply is not None:
+            reply.discard()
+
+    def download_photo(self, photo_sizes: list, detail):
+        # Download the smallest version that's big enough and resize it to what OpenAI uses.
+        photo = pick_photo_size(photo_sizes, detail)
+        downloaded_file = self.download(photo.file_id)
+        with metrics.timer("prepare_image"):
+            downloaded_file, width, height = prepare_image(downloaded_file, detail)
+        # Size and token cost are computed once here, never from the image bytes again.
+        return image_part(downloaded_file, width, height, detail)
+
+    def download(self, file_id):
+        with metrics.timer("download"):
+            file = self.bot.get_file(file_id)
+            return self.bot.download_file(file.file_path)
+
+    def model_flag(self, msg: str):
+        # --fast or --strong picks the model instead of the router.
+        for flag, choice in ROUTE_FLAGS.items():
+            if flag in msg:
+                return msg.replace(flag, "").strip(), choice
+        return msg, None
+
+    def photo_detail(self, msg: str):
+        detail = "low"
+        if "-h" in msg or "--high" in msg:
+            detail = "high"
+            msg = msg.replace("--high", "").replace("-h", "").strip()
+        return msg, detail
+
+    def voice_response(self, response: str):
+        # Voice notes are answered with voice notes, unless something else was asked for.
+        if (
+            not response.startswith("VOICE_REQUESTED_123")
+            and not response.startswith("IMAGE_REQUESTED_123")
+            and not response.startswith("TEXT_REQUESTED_123")
+        ):
+            response = "VOICE_REQUESTED_123: " + response
+        return response
+
+    def cancel_reply(self, reply: StreamingReply, response: str):
+        # What was streamed until /cancel stays in the chat.
+        text = self.stream_text(response)
+        if text.strip() and reply.fits(text):
+            reply.finish(text)
+        elif not text.strip():
+            reply.discard()
+
+    def voice_text(self, text: str):
+        # What to speak of a streamed answer to a voice note. Empty while it could still turn
+        # out to be a control token, None if the answer isn't meant to be spoken.
+        if any(token.startswith(text) for token in CONTROL_TOKENS):
+            return ""
+        if text.startswith("VOICE_REQUESTED_123"):
+            return text.replace("VOICE_REQUESTED_123", "", 1).lstrip(":").lstrip()
+        elif text.startswith(CONTROL_TOKENS):
+            return None
+        return text
+
+    def stream_text(self, text: str):
+        # Hold back until we know the response isn't an image or voice request.
+        if any(token.startswith(text) for token in CONTROL_TOKENS):
+            return ""
+        if text.startswith("TEXT_REQUESTED_123"):
+            return text.replace("TEXT_REQUESTED_123", "").strip(":").strip()
+        elif text.startswith(CONTROL_TOKENS):
+            return ""
+        return text
+
+    def send_response(self, chat_id, response: str, reply: StreamingReply = None):
+        with metrics.timer("escape_markdown"):
+            escaped = escape_markdown(response)
+        attempts = [
+            (escaped, "MarkdownV2", "!! Couldn't parse Markdown V2 !!"),
+            (response, "Markdown", "!! Couldn't parse Markdown !!"),
+            (response, None, None),
+        ]
+        for text, parse_mode, parse_error in attempts:
+            try:
+                if reply is not None and reply.fits(text):
+                    # Replace the streamed plain text with the properly formatted response.
+                    return reply.finish(text, parse_mode)
+                if reply is not None:
+                    # Too long for a single message, send it in parts instead.
+                    reply.discard()
+                    reply = None
+                return self.send_message_bot(chat_id, text, parse_mode=parse_mode)
+            except Exception as e:
+                if "can't parse" in str(e) and parse_error:
+                    print(parse_error)
+                else:
+                    raise e
 
     def handle_msg(self, message: Message):
         username = message.from_user.username
         chat_id = message.chat.id
         if not self.init_admin_cmds and username in self.admins:
-            self.bot.set_my_commands(
-                self.admin_command_list + self.command_list,
-                scope=BotCommandScopeChat(chat_id),
+            self.set_commands(
+                self.admin_command_list + self.command_list, scope=BotCommandScopeChat(chat_id)
             )
             self.init_admin_cmds = True
-        if username in self.users["users"]:
+        if self.storage.has_user(username):
             func = self.determine_function(message)
-            func(message)
+            current_command.set(func.__name__)
+            with metrics.timer("handle"):
+                func(message)
         else:
             self.send_message_bot(
                 chat_id,
                 "You dont have access to LockwardGPT. Ask @carloslockward to grant you access.",
             )
 
+    def cancel_token(self, chat_id):
+        return self.dispatcher.cancel_token(chat_id)
+
+    def is_cancelled(self, chat_id):
+        token = self.cancel_token(chat_id)
+        return token is not None and token.is_set()
+
+    def cancel_report(self, running, dropped, keep_partial):
+        if not running and not dropped:
+            return "There is nothing to cancel."
+        lines = []
+        if running:
+            lines.append(
+                "Cancelled. The partial response was kept in the context."
+                if keep_partial
+                else "Cancelled."
+            )
+        if dropped:
+            lines.append(f"Dropped {dropped} message(s) that were waiting for an answer.")
+        return "\n".join(lines)
+
+    def cancel_response(self, message: Message):
+        chat_id = message.chat.id
+        keep_partial = "keep" in message.text.split()[1:]
+        dropped = self.coalescer.drop(chat_id)
+        running, queued = self.dispatcher.cancel(chat_id, keep_partial)
+        self.send_message_bot(chat_id, self.cancel_report(running, dropped + queued, keep_partial))
+
+    def is_cancel(self, message: Message):
+        return message.content_type == "text" and message.text.split()[:1] == ["/cancel"]
+
+    def mergeable(self, message: Message):
+        # Plain text and photos can be answered together, commands and voice notes can't.
+        if message.content_type == "text":
+            return not message.text.strip().startswith("/")
+        return message.content_type == "photo"
+
+    def enqueue_msg(self, message: Message):
+        if self.is_cancel(message):
+            # Handled right away, in the chat's queue it would wait for what it has to stop.
+            if self.storage.has_user(message.from_user.username):
+                self.cancel_response(message)
+        elif self.mergeable(message):
+            self.coalescer.add(
+                message.chat.id, message, message.from_user.id, message.media_group_id
+            )
+        else:
+            # Whatever the chat sent before this goes first.
+            self.coalescer.flush(message.chat.id)
+            self.submit(message)
+
+    def submit_batch(self, messages: list):
+        self.submit(messages[0] if len(messages) == 1 else MergedMessage(messages))
+
+    def submit(self, message: Message):
+        if not self.dispatcher.submit(message.chat.id, message):
+            print(f"!! Queue is full. Dropping update from chat {message.chat.id} !!")
+            self.send_message_bot(
+                message.chat.id, "LockwardGPT is busy at the moment. Try again in a few seconds."
+            )
+
+    def process_update(self, update: dict):
+        # Raw update as sent by Telegram, telebot routes it to enqueue_msg.
+        self.bot.process_new_updates([Update.de_json(update)])
+
+    # start_listening and start_webhook can be called again after they failed, the bot keeps
+    # its state and Telegram is only told what it doesn't know yet. Call shutdown when done.
+
+    def started(self, start):
+        self.starts += 1
+        if self.starts == 1:
+            print(f"Bot started in {startup.report()}")
+        else:
+            print(f"Bot restarted in {(perf_counter() - start) * 1000:.0f}ms")
+
     def start_listening(self):
-        print("Bot started!")
+        start = perf_counter()
+        self.publish_commands()
+        if not self.polling_ready:
+            with startup.phase("remove_webhook"):
+                # Polling doesn't work while a webhook is set.
+                self.bot.remove_webhook()
+            self.polling_ready = True
+        self.started(start)
         self.bot.infinity_polling()
 
+    def start_webhook(self, url, secret_token, host="0.0.0.0", port=8443, max_connections=40):
+        start = perf_counter()
+        self.publish_commands()
+        # Updates are processed by the dispatcher workers, see max_workers.
+        self.webhook = WebhookServer(
+            self.process_update, secret_token, host, port, path=webhook_path(url)
+        )
+        webhook = (url, secret_token, max_connections)
+        if self.webhook_set != webhook:
+            with startup.phase("set_webhook"):
+                self.bot.set_webhook(
+                    url=url,
+                    secret_token=secret_token,
+                    max_connections=max_connections,
+                    allowed_updates=["message"],
+                )
+            self.webhook_set = webhook
+        self.started(start)
+        self.webhook.serve_forever()
+
+    def shutdown(self):
+        # Lets every chat finish what it was sent.
+        self.dispatcher.shutdown()
+
+
+def build_router():
+    return ModelRouter(fast=FAST_ENGINE, strong="gpt-4.1") if FAST_ENGINE else None
+
+
+def start_warm_up(model):
+    # The first message would otherwise wait for the tokenizer and PIL to load.
+    timer = PhaseTimer(metrics, "warm_up")
+
+    def run():
+        with timer.phase("tokenizer"):
+            count_text_tokens("warm up", model)
+        with timer.phase("pil"):
+            pil_image().init()
+        print(f"Warmed up in {timer.report()}")
+
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
+
+
+def build_bot(storage: Storage):
+    with startup.phase("context"):
+        context = ContextStore(context_size=20, backend=storage)
+    with startup.phase("chatgpt"):
+        chatgpt = ChatGPT(
+            OPENAI_API_KEY,
+            context=context,
+            context_size=20,
+            compact_tokens=COMPACT_TOKENS,
+            summary_engine=SUMMARY_ENGINE,
+            router=build_router(),
+        )
+    with startup.phase("bot"):
+        return LockwardBot(chatgpt, TELEGRAM_API_KEY, storage)
+
+
+def build_shard(shard):
+    # Runs in each worker process, every shard has its own connection to the database.
+    storage = Storage("lockward.db")
+    if METRICS_PORT:
+        MetricsServer(metrics, port=METRICS_PORT + 1 + shard).start()
+    bot = build_bot(storage)
+    start_warm_up(bot.chatgpt.model_engine)
+    bot.publish_commands()
+    return bot
+
+
+def run_sharded():
+    router = ShardRouter(SHARDS, build_shard)
+    router.start()
+    front = telebot.TeleBot(TELEGRAM_API_KEY, threaded=False)
+    try:
+        if WEBHOOK_URL:
+            front.set_webhook(
+                url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=["message"]
+            )
+            WebhookServer(
+                router.route,
+                WEBHOOK_SECRET,
+                WEBHOOK_HOST,
+                WEBHOOK_PORT,
+                path=webhook_path(WEBHOOK_URL),
+            ).serve_forever()
+        else:
+            front.remove_webhook()
+            print(f"Routing updates to {SHARDS} shards...")
+            router.poll(TELEGRAM_API_KEY)
+    except KeyboardInterrupt:
+        print("Bot is done!")
+    finally:
+        router.stop()
+
 
 if __name__ == "__main__":
-    while True:
-        try:
-            context = {}
-            if Path("context.json").exists():
-                try:
-                    with Path("context.json").open("r") as cf:
-                        context = json.load(cf)
-                except:
-                    print(f"Failed to load context! Exception:\n {traceback.format_exc()}")
-            chatgpt = ChatGPT(OPENAI_API_KEY, context=context, context_size=20)
-            bot = LockwardBot(chatgpt, TELEGRAM_API_KEY)
-            bot.start_listening()
-            print("Bot is done!")
-            break
-        except KeyboardInterrupt:
-            print("Bot is done!")
-            break
-        except Exception as e:
-            print(f"Exception {e}. Restarting...")
-        finally:
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise SystemExit("Set WEBHOOK_SECRET to use a webhook.")
+    with startup.phase("storage"):
+        storage = Storage("lockward.db")
+        # context.json and users.json are only imported into an empty database.
+        storage.import_json("context.json", "users.json")
+    if SHARDS > 1:
+        run_sharded()
+        storage.export_json("context.json", "users.json", context_size=20)
+    else:
+        if METRICS_PORT:
+            MetricsServer(metrics, port=METRICS_PORT).start()
+        bot = None
+        while True:
             try:
-                print("Saving context...")
-                with Path("context.json").open("w") as cf:
-                    json.dump(chatgpt.context, cf)
-            except:
-                print(f"Failed to save context! Exception:\n {traceback.format_exc()}")
+                # After a crash the same bot starts again, with its contexts, queues and caches.
+                # It is only built again if building it is what failed.
+                if bot is None:
+                    bot = build_bot(storage)
+                    start_warm_up(bot.chatgpt.model_engine)
+                if WEBHOOK_URL:
+                    bot.start_webhook(WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT)
+                else:
+                    bot.start_listening()
+                print("Bot is done!")
+                break
+            except KeyboardInterrupt:
+                print("Bot is done!")
+                break
+            except Exception as e:
+                print(f"Exception {e}. Restarting...")
+                storage.flush()
+        try:
+            if bot is not None:
+                bot.shutdown()
+            print("Saving context...")
+            storage.flush()
+            storage.export_json("context.json", "users.json", context_size=20)
+        except:
+            print(f"Failed to save context! Exception:\n {traceback.format_exc()}")
+    storage.close()
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class MediaCache:
+    # Generated audio and images on disk, named after the hash of everything that produced them
+    # (model, voice, size, prompt...), so the same request never hits the API twice. It is an LRU
+    # bounded by max_bytes, files are touched when read so the order survives restarts. The
+    # Telegram file_id of a file that was already sent is kept next to it, sending it again
+    # then needs no upload at all.
+    def __init__(self, path="media_cache", max_bytes=200_000_000) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.file_id_hits = 0
+        os.makedirs(path, exist_ok=True)
+        files = []
+        for name in os.listdir(path):
+            if name.endswith(".bin"):
+                stat = os.stat(os.path.join(path, name))
+                files.append((stat.st_mtime, name[: -len(".bin")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+    def key(self, *parts):
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def __file(self, key, extension="bin"):
+        return os.path.join(self.path, f"{key}.{extension}")
+
+    def __remove(self, key):
+        self.size -= self.entries.pop(key, 0)
+        for extension in ("bin", "id"):
+            try:
+                os.remove(self.__file(key, extension))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        with self.lock:
+            try:
+                with open(self.__file(key), "rb") as f:
+                    data = f.read()
+                os.utime(self.__file(key))
+            except FileNotFoundError:
+                # Also when another process evicted it.
+                self.size -= self.entries.pop(key, 0)
+                self.misses += 1
+                return None
+            if key not in self.entries:
+                self.size += len(data)
+            self.entries[key] = len(data)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            temp = self.__file(key, f"{os.getpid()}.tmp")
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, self.__file(key))
+            self.size += len(data) - self.entries.get(key, 0)
+            self.entries[key] = len(data)
+            self.entries.move_to_end(key)
+            while self.size > self.max_bytes:
+                self.__remove(next(iter(self.entries)))
+
+    def file_id(self, key):
+        try:
+            with open(self.__file(key, "id"), "r") as f:
+                file_id = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if not file_id:
+            return None
+        with self.lock:
+            self.file_id_hits += 1
+        return file_id
+
+    def set_file_id(self, key, file_id):
+        with self.lock:
+            if key in self.entries:
+                with open(self.__file(key, "id"), "w") as f:
+                    f.write(file_id)
+
+    def forget_file_id(self, key):
+        try:
+            os.remove(self.__file(key, "id"))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "file_id_hits": self.file_id_hits,
+            }
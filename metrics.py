@@ -0,0 +1,175 @@
+import threading
+import contextvars
+from time import perf_counter
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from a token count to a slow completion.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+# Command the current update is running, every stage timed while handling it is labelled with
+# it. A context variable, so it follows both worker threads and asyncio tasks.
+current_command = contextvars.ContextVar("command", default="")
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # Estimated like Prometheus' histogram_quantile, interpolating inside the bucket.
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = min(BUCKETS[i], self.max)
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+
+class Metrics:
+    # Latency histograms of every stage of handling an update (download, token counting, OpenAI
+    # calls, escaping, sending...) labelled by stage, command and model, plus gauges that are
+    # read when the metrics are rendered.
+    def __init__(self, prefix="lockward") -> None:
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}  # (stage, command, model) -> Histogram
+        self.gauges = {}  # name -> function returning the current value
+
+    def observe(self, stage, seconds, model=""):
+        key = (stage, current_command.get(), model or "")
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage, model=""):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start, model)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def render(self):
+        # Prometheus text exposition format.
+        name = f"{self.prefix}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each stage of handling an update.",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            histograms = [(key, list(h.counts), h.total, h.count) for key, h in self.histograms.items()]
+        for (stage, cmd, model), counts, total, count in sorted(histograms):
+            labels = f'stage="{stage}",command="{cmd}",model="{model}"'
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+        for gauge, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{gauge} gauge")
+            lines.append(f"{self.prefix}_{gauge} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # (stage, model) -> merged histogram over every command.
+        merged = {}
+        with self.lock:
+            for (stage, _, model), histogram in self.histograms.items():
+                total = merged.setdefault((stage, model), Histogram())
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.total += histogram.total
+                total.count += histogram.count
+                total.max = max(total.max, histogram.max)
+        return merged
+
+
+class PhaseTimer:
+    # Wall time of each phase of something that runs once, like starting the bot. Every phase
+    # is also exported as a gauge, a phase that runs again (a restart) replaces its time.
+    def __init__(self, metrics: Metrics, name="startup") -> None:
+        self.metrics = metrics
+        self.name = name
+        self.phases = {}  # phase -> seconds, in the order they first ran
+
+    @contextmanager
+    def phase(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = perf_counter() - start
+            self.metrics.gauge(f"{self.name}_{phase}_seconds", lambda: self.phases[phase])
+
+    def report(self, *phases):
+        phases = [(p, s) for p, s in self.phases.items() if not phases or p in phases]
+        total = sum(seconds for _, seconds in phases)
+        parts = ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in phases)
+        return f"{total:.3f}s ({parts})"
+
+
+class MetricsServer:
+    # Serves Metrics.render() on GET /metrics for a Prometheus scraper. Only listens on
+    # localhost unless told otherwise.
+    def __init__(self, metrics: Metrics, host="127.0.0.1", port=9464, path="/metrics") -> None:
+        self.metrics = metrics
+        self.path = path
+        self.httpd = ThreadingHTTPServer((host, port), self.__handler())
+        self.httpd.daemon_threads = True
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        thread.start()
+        host, port = self.httpd.server_address[:2]
+        print(f"Metrics on http://{host}:{port}{self.path}")
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+metrics = Metrics()
+startup = PhaseTimer(metrics)
@@ -0,0 +1,108 @@
+import threading
+from collections import deque
+from time import monotonic
+from openai import RateLimitError, APITimeoutError
+
+# A request that failed with these is sent to the other model right away.
+FALLBACK_ERRORS = (RateLimitError, APITimeoutError)
+
+# Flag in the message -> model asked for
+ROUTE_FLAGS = {"--fast": "fast", "--strong": "strong"}
+
+
+class ModelRouter:
+    # Picks the model of each chat completion. Short text prompts go to the fast model, long ones,
+    # photos and anything asked for with --strong go to the strong one. A model that has been
+    # slow (p95 over its max_p95) or failing lately is avoided while the other one is fine.
+    # Only the last `window` requests of the last `horizon` seconds count, so a model that was
+    # avoided is tried again once its bad requests are old enough.
+    def __init__(
+        self,
+        fast="gpt-4.1-mini",
+        strong="gpt-4.1",
+        max_fast_tokens=250,  # Longest prompt the fast model gets without being asked
+        max_p95=None,  # model -> seconds, 5 for the fast model and 15 for the strong one by default
+        max_error_rate=0.25,
+        min_samples=10,  # Requests needed before a model is judged
+        window=50,
+        horizon=300,
+    ) -> None:
+        self.fast = fast
+        self.strong = strong
+        self.max_fast_tokens = max_fast_tokens
+        self.max_p95 = max_p95 if max_p95 is not None else {fast: 5.0, strong: 15.0}
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.horizon = horizon
+        self.lock = threading.Lock()
+        # model -> deque of (time, seconds, failed)
+        self.samples = {fast: deque(maxlen=window), strong: deque(maxlen=window)}
+        self.decisions = {}  # (model, reason) -> count
+        self.fallbacks = 0
+
+    def __recent(self, model, now):
+        return [s for s in self.samples[model] if now - s[0] <= self.horizon]
+
+    def __health(self, model, now):
+        # None when the model is fine, otherwise why it isn't.
+        samples = self.__recent(model, now)
+        if len(samples) < self.min_samples:
+            return None
+        if sum(failed for _, _, failed in samples) / len(samples) > self.max_error_rate:
+            return "failing"
+        latencies = sorted(seconds for _, seconds, failed in samples if not failed)
+        if latencies and latencies[int(0.95 * (len(latencies) - 1))] > self.max_p95.get(model, 30):
+            return "slow"
+        return None
+
+    def other(self, model):
+        return self.strong if model == self.fast else self.fast
+
+    def route(self, prompt_tokens, attachments=False, flag=None):
+        if flag in ("fast", "strong"):
+            model = self.fast if flag == "fast" else self.strong
+            reason = f"{flag} flag"
+        elif attachments:
+            model, reason = self.strong, "attachments"
+        elif prompt_tokens > self.max_fast_tokens:
+            model, reason = self.strong, "long prompt"
+        else:
+            model, reason = self.fast, "short prompt"
+        with self.lock:
+            if flag is None:
+                now = monotonic()
+                health = self.__health(model, now)
+                if health is not None and self.__health(self.other(model), now) is None:
+                    model, reason = self.other(model), f"{model} {health}"
+            self.decisions[(model, reason)] = self.decisions.get((model, reason), 0) + 1
+        return model
+
+    def record(self, model, seconds, failed=False):
+        with self.lock:
+            if model in self.samples:
+                self.samples[model].append((monotonic(), seconds, failed))
+
+    def fell_back(self):
+        with self.lock:
+            self.fallbacks += 1
+
+    def stats(self):
+        with self.lock:
+            now = monotonic()
+            models = {}
+            for model in (self.fast, self.strong):
+                samples = self.__recent(model, now)
+                latencies = sorted(seconds for _, seconds, failed in samples if not failed)
+                models[model] = {
+                    "requests": len(samples),
+                    "p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+                    "error_rate": (
+                        sum(failed for _, _, failed in samples) / len(samples) if samples else 0.0
+                    ),
+                    "health": self.__health(model, now) or "ok",
+                }
+            return {
+                "models": models,
+                "decisions": dict(self.decisions),
+                "fallbacks": self.fallbacks,
+            }
@@ -0,0 +1,305 @@
+import re
+import random
+import asyncio
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import sleep, monotonic, perf_counter
+from metrics import metrics
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def parse_duration(value: str):
+    # OpenAI sends reset times like "1s", "6m0s" or "20ms".
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_RE.findall(value))
+
+
+def parse_retry_after(value: str):
+    # Seconds to wait, or an HTTP date. None when it is neither.
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute) -> None:
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = monotonic()
+
+    def __refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # Seconds until amount can be taken. Requests bigger than the bucket only wait for it
+        # to be full, otherwise they would never run.
+        self.__refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0) * 60 / self.capacity
+
+    def take(self, amount):
+        self.level -= amount
+
+    def give(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit, remaining, now):
+        # What the server says is always right, our own count only estimates it.
+        self.__refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+class OpenAIScheduler:
+    # Shared by every OpenAI call. Requests and tokens per minute are tracked with token buckets
+    # kept in sync with the x-ratelimit-* response headers. Calls wait in a queue when we are
+    # close to the limit instead of failing, and when several are waiting, the user with the
+    # fewest recent requests goes first so one heavy user can't starve the others. Failed calls
+    # are retried with exponential backoff and jitter.
+    def __init__(
+        self,
+        requests_per_minute=500,
+        tokens_per_minute=30000,
+        max_retries=5,
+        base_delay=0.5,
+        max_delay=30,
+        max_wait=120,  # Seconds a call can wait in the queue before giving up
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.async_waiters = set()  # (loop, event) of every aacquire waiting
+        self.recent = {}  # user -> times of their requests in the last minute
+        self.paused_until = 0.0
+        self.sequence = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def __recent(self, user, now):
+        times = self.recent.get(user)
+        if times is None:
+            return 0
+        while times and times[0] < now - 60:
+            times.popleft()
+        if not times:
+            del self.recent[user]
+            return 0
+        return len(times)
+
+    def __enqueue(self, user):
+        self.sequence += 1
+        ticket = (user, self.sequence)
+        self.waiting.append(ticket)
+        return ticket
+
+    def __turn(self, ticket, tokens, now):
+        # Seconds the ticket still has to wait, 0 when its request was just counted.
+        first = min(self.waiting, key=lambda t: (self.__recent(t[0], now), t[1]))
+        if first is not ticket:
+            return 1
+        wait = max(
+            self.paused_until - now,
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(tokens, now),
+        )
+        if wait <= 0:
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.recent.setdefault(ticket[0], deque()).append(now)
+            return 0
+        return wait
+
+    def __notify(self):
+        # Wakes up the waiting calls, threads and event loop tasks.
+        self.condition.notify_all()
+        for loop, event in self.async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def acquire(self, user=None, tokens=0):
+        with self.condition:
+            ticket = self.__enqueue(user)
+            deadline = monotonic() + self.max_wait
+            try:
+                while True:
+                    now = monotonic()
+                    if now > deadline:
+                        raise RateLimitTimeout("Waited too long for the OpenAI rate limit")
+                    wait = self.__turn(ticket, tokens, now)
+                    if wait <= 0:
+                        return
+                    self.condition.wait(min(wait, deadline - now))
+            finally:
+                self.waiting.remove(ticket)
+                self.__notify()
+
+    async def aacquire(self, user=None, tokens=0):
+        # Same as acquire, waiting on the event loop instead of holding a thread.
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            ticket = self.__enqueue(user)
+            self.async_waiters.add(waiter)
+        deadline = monotonic() + self.max_wait
+        try:
+            while True:
+                with self.condition:
+                    now = monotonic()
+                    if now > deadline:
+                        raise RateLimitTimeout("Waited too long for the OpenAI rate limit")
+                    wait = self.__turn(ticket, tokens, now)
+                    if wait <= 0:
+                        return
+                    waiter[1].clear()
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), min(wait, deadline - now))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+                self.waiting.remove(ticket)
+                self.__notify()
+
+    def settle(self, estimated_tokens=0, used_tokens=None):
+        # Give back what we over-estimated, or charge what we under-estimated.
+        if used_tokens is not None:
+            with self.condition:
+                self.tokens.take(used_tokens - estimated_tokens)
+                self.__notify()
+
+    def refund(self, tokens=0):
+        # Gives back the tokens of a failed request, they are taken again if it is retried. The
+        # request itself still counts, it reached the API.
+        with self.condition:
+            self.tokens.give(tokens)
+            self.__notify()
+
+    def update_limits(self, headers):
+        now = monotonic()
+
+        def header(name, convert=int):
+            value = headers.get(name)
+            return convert(value) if value is not None else None
+
+        with self.condition:
+            self.requests.sync(
+                header("x-ratelimit-limit-requests"), header("x-ratelimit-remaining-requests"), now
+            )
+            self.tokens.sync(
+                header("x-ratelimit-limit-tokens"), header("x-ratelimit-remaining-tokens"), now
+            )
+
+    def backoff(self, attempt, e: Exception = None):
+        delay = min(self.max_delay, self.base_delay * 2**attempt) * random.uniform(0.5, 1.5)
+        response = getattr(e, "response", None)
+        if response is not None:
+            retry_after_ms = parse_retry_after(response.headers.get("retry-after-ms", ""))
+            retry_after = parse_retry_after(response.headers.get("retry-after", ""))
+            if retry_after_ms is not None:
+                delay = max(delay, retry_after_ms / 1000)
+            elif retry_after is not None:
+                delay = max(delay, retry_after)
+            elif response.headers.get("x-ratelimit-reset-requests") is not None:
+                delay = max(delay, parse_duration(response.headers["x-ratelimit-reset-requests"]))
+        if isinstance(e, RateLimitError):
+            # Everybody waits, not just this call.
+            with self.condition:
+                self.rate_limited += 1
+                self.paused_until = max(self.paused_until, monotonic() + delay)
+        self.retries += 1
+        return delay
+
+    def should_retry(self, e: Exception, attempt, max_retries=None):
+        if max_retries is None:
+            max_retries = self.max_retries
+        if attempt >= max_retries or not isinstance(e, RETRYABLE_ERRORS):
+            return False
+        # Running out of credits won't fix itself by waiting.
+        return "insufficient_quota" not in str(e)
+
+    def call(self, request, user=None, tokens=0, model="", max_retries=None, on_response=None):
+        # request() must return a raw response (client.<api>.with_raw_response.<method>(...)),
+        # the parsed result is returned. For streams that is as soon as the response starts.
+        # max_retries overrides the scheduler's, 0 when the caller has somewhere else to go.
+        # on_response is called with the seconds the request took, without waiting for a turn.
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            with metrics.timer("rate_limit_wait", model):
+                self.acquire(user, tokens)
+            start = perf_counter()
+            try:
+                raw = request()
+                seconds = perf_counter() - start
+                metrics.observe("openai", seconds, model)
+                if on_response is not None:
+                    on_response(seconds)
+            except Exception as e:
+                if not self.should_retry(e, attempt, max_retries):
+                    raise e
+                print(f"!! OpenAI call failed ({type(e).__name__}). Retrying... !!")
+                self.refund(tokens)
+                sleep(self.backoff(attempt, e))
+                continue
+            self.update_limits(raw.headers)
+            return raw.parse()
+
+    async def acall(
+        self, request, user=None, tokens=0, model="", max_retries=None, on_response=None
+    ):
+        # Same as call, for the async client.
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            with metrics.timer("rate_limit_wait", model):
+                await self.aacquire(user, tokens)
+            start = perf_counter()
+            try:
+                raw = await request()
+                seconds = perf_counter() - start
+                metrics.observe("openai", seconds, model)
+                if on_response is not None:
+                    on_response(seconds)
+            except Exception as e:
+                if not self.should_retry(e, attempt, max_retries):
+                    raise e
+                print(f"!! OpenAI call failed ({type(e).__name__}). Retrying... !!")
+                self.refund(tokens)
+                await asyncio.sleep(self.backoff(attempt, e))
+                continue
+            self.update_limits(raw.headers)
+            # Raw responses parse synchronously, also on the async client.
+            return raw.parse()
+
+    def stats(self):
+        with self.condition:
+            now = monotonic()
+            return {
+                "waiting": len(self.waiting),
+                "requests_available": int(self.requests.level),
+                "tokens_available": int(self.tokens.level),
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "paused_for": max(self.paused_until - now, 0),
+            }
@@ -0,0 +1,85 @@
+import zlib
+import traceback
+import multiprocessing
+from time import sleep
+from telebot import apihelper
+
+
+def update_chat_id(update: dict):
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["from"]["id"]
+    return None
+
+
+def shard_for(chat_id, shards):
+    # hash() is salted per process, crc32 gives every process the same answer.
+    return zlib.crc32(str(chat_id).encode("utf-8")) % shards
+
+
+def run_shard(shard, updates, build_bot):
+    # Entry point of a worker process. It owns the chats that hash to its shard, updates come
+    # in order from a single queue so the bot's dispatcher keeps per-chat ordering.
+    bot = build_bot(shard)
+    print(f"Shard {shard} started!")
+    try:
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            try:
+                bot.process_update(update)
+            except Exception:
+                print(f"Shard {shard} failed to process update!\n {traceback.format_exc()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bot.dispatcher.shutdown()
+        bot.storage.close()
+
+
+class ShardRouter:
+    # Front process: receives every update and routes it by chat_id to one of N worker
+    # processes. Usage counters are shared through the database, so the admin usage commands
+    # report totals for all shards no matter which shard handles them.
+    def __init__(self, shards, build_bot, max_queue=1000) -> None:
+        self.shards = shards
+        self.updates = [multiprocessing.Queue(maxsize=max_queue) for _ in range(shards)]
+        self.processes = [
+            multiprocessing.Process(
+                target=run_shard, args=(shard, self.updates[shard], build_bot), name=f"shard-{shard}"
+            )
+            for shard in range(shards)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def route(self, update: dict):
+        chat_id = update_chat_id(update)
+        shard = shard_for(chat_id, self.shards) if chat_id is not None else 0
+        self.updates[shard].put(update)
+
+    def poll(self, token, timeout=20):
+        offset = None
+        while True:
+            try:
+                updates = apihelper.get_updates(
+                    token, offset=offset, timeout=timeout, long_polling_timeout=timeout
+                )
+            except Exception as e:
+                print(f"Failed to get updates: {e}. Retrying...")
+                sleep(3)
+                continue
+            for update in updates:
+                self.route(update)
+                offset = update["update_id"] + 1
+
+    def stop(self):
+        for updates in self.updates:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
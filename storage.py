@@ -0,0 +1,238 @@
+import json
+import queue
+import sqlite3
+import threading
+import traceback
+from time import time, monotonic
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat_id, id);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS usage (
+    username TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    amount INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (username, kind)
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class Storage:
+    # SQLite database in WAL mode, so readers never block the writer. Every write goes through
+    # a single writer thread that commits them in batches every commit_interval seconds.
+    def __init__(self, path="lockward.db", commit_interval=0.5, max_batch=500) -> None:
+        self.path = str(path)
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.local = threading.local()
+        self.writes = queue.Queue()
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+
+        connection = self.__connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection.commit()
+
+        self.writer = threading.Thread(target=self.__write_loop, name="storage", daemon=True)
+        self.writer.start()
+
+    def __connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def __reader(self):
+        # One read connection per thread, sqlite connections can't be shared safely.
+        if not hasattr(self.local, "connection"):
+            self.local.connection = self.__connect()
+        return self.local.connection
+
+    def __write(self, sql, params=()):
+        with self.pending_lock:
+            self.pending += 1
+        self.writes.put((sql, params))
+
+    def __write_loop(self):
+        connection = self.__connect()
+        while True:
+            batch = [self.writes.get()]
+            deadline = monotonic() + self.commit_interval
+            # Keep collecting until the interval is over, unless somebody is waiting for a flush.
+            while len(batch) < self.max_batch and isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self.writes.get(timeout=max(deadline - monotonic(), 0)))
+                except queue.Empty:
+                    break
+            writes = [item for item in batch if isinstance(item, tuple)]
+            try:
+                with connection:
+                    for sql, params in writes:
+                        connection.execute(sql, params)
+            except:
+                print(f"Failed to write to storage! Exception:\n {traceback.format_exc()}")
+            with self.pending_lock:
+                self.pending -= len(writes)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is None:
+                    connection.close()
+                    return
+
+    def flush(self):
+        # Blocks until everything written so far has been committed.
+        done = threading.Event()
+        self.writes.put(done)
+        done.wait()
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+
+    def __read(self, sql, params=()):
+        # Make sure readers see writes still waiting for the next batch.
+        if self.pending:
+            self.flush()
+        return self.__reader().execute(sql, params).fetchall()
+
+    # Context backend, see context_store.ContextStore
+
+    def exists(self):
+        return bool(self.__read("SELECT 1 FROM messages LIMIT 1"))
+
+    def load(self, chat_id, limit):
+        rows = self.__read(
+            "SELECT role, content, tokens FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+            (str(chat_id), limit),
+        )
+        if not any(role == "system" for role, _, _ in rows):
+            # The summary of a compacted chat is its oldest message, but it is always loaded.
+            summary = self.__read(
+                "SELECT role, content, tokens FROM messages WHERE chat_id = ? AND role = 'system' "
+                "ORDER BY id DESC LIMIT 1",
+                (str(chat_id),),
+            )
+            if summary:
+                rows = rows[: limit - 1] + summary
+        messages = []
+        for role, content, tokens in reversed(rows):
+            message = {"role": role, "content": json.loads(content)}
+            if tokens is not None:
+                message["tokens"] = tokens
+            messages.append(message)
+        return messages
+
+    def append(self, chat_id, message):
+        self.__write(
+            "INSERT INTO messages (chat_id, role, content, tokens, created) VALUES (?, ?, ?, ?, ?)",
+            (
+                str(chat_id),
+                message["role"],
+                json.dumps(message["content"]),
+                message.get("tokens"),
+                time(),
+            ),
+        )
+
+    def save(self, chat_id, messages):
+        # Messages are written as they are appended, nothing left to do.
+        pass
+
+    def replace(self, chat_id, messages):
+        # Writes are applied in order, nobody reads the chat in between (see __read).
+        self.clear(chat_id)
+        for message in messages:
+            self.append(chat_id, message)
+
+    def clear(self, chat_id):
+        self.__write("DELETE FROM messages WHERE chat_id = ?", (str(chat_id),))
+
+    def chat_ids(self):
+        return [row[0] for row in self.__read("SELECT DISTINCT chat_id FROM messages")]
+
+    # Users
+
+    def get_users(self):
+        return [row[0] for row in self.__read("SELECT username FROM users ORDER BY rowid")]
+
+    def has_user(self, username):
+        return bool(self.__read("SELECT 1 FROM users WHERE username = ?", (username,)))
+
+    def add_user(self, username):
+        self.__write("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+
+    def remove_user(self, username):
+        self.__write("DELETE FROM users WHERE username = ?", (username,))
+
+    # Usage counters
+
+    def add_usage(self, kind, username, amount=1):
+        self.__write(
+            "INSERT INTO usage (username, kind, amount) VALUES (?, ?, ?) "
+            "ON CONFLICT (username, kind) DO UPDATE SET amount = amount + excluded.amount",
+            (username, kind, amount),
+        )
+
+    def get_usage(self, kind):
+        rows = self.__read("SELECT username, amount FROM usage WHERE kind = ?", (kind,))
+        return dict(rows)
+
+    # Settings the bot keeps between runs
+
+    def get_setting(self, key, default=None):
+        rows = self.__read("SELECT value FROM settings WHERE key = ?", (key,))
+        return rows[0][0] if rows else default
+
+    def set_setting(self, key, value):
+        self.__write(
+            "INSERT INTO settings (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    # JSON import/export, same format as the old context.json and users.json
+
+    def import_json(self, context_path="context.json", user_path="users.json"):
+        if Path(context_path).exists() and not self.exists():
+            try:
+                with Path(context_path).open("r") as cf:
+                    for chat_id, messages in json.load(cf).items():
+                        for message in messages:
+                            self.append(chat_id, message)
+                print(f"Imported context from {context_path}")
+            except:
+                print(f"Failed to import context! Exception:\n {traceback.format_exc()}")
+        if Path(user_path).exists() and not self.get_users():
+            try:
+                with Path(user_path).open("r") as uf:
+                    for username in json.load(uf)["users"]:
+                        self.add_user(username)
+                print(f"Imported users from {user_path}")
+            except:
+                print(f"Failed to import users! Exception:\n {traceback.format_exc()}")
+        self.flush()
+
+    def export_json(self, context_path="context.json", user_path="users.json", context_size=None):
+        context = {}
+        for chat_id in self.chat_ids():
+            context[chat_id] = self.load(chat_id, context_size if context_size else -1)
+        with Path(context_path).open("w") as cf:
+            json.dump(context, cf)
+        with Path(user_path).open("w") as uf:
+            json.dump({"users": self.get_users()}, uf)
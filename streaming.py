@@ -0,0 +1,268 @@
+import re
+import asyncio
+import threading
+from collections import deque
+from time import sleep, monotonic
+
+RETRY_AFTER_RE = re.compile(r"retry after (\d+)")
+SENTENCE_END_RE = re.compile(r"[.!?…:;]+[\"')\]]*\s+|\n+")
+
+
+def sentence_cut(text: str, min_length, max_length):
+    # Where to cut text so the first part ends at a sentence boundary and is at least
+    # min_length long, 0 if it isn't possible yet.
+    for match in SENTENCE_END_RE.finditer(text):
+        if match.end() > max_length:
+            break
+        if match.end() >= min_length:
+            return match.end()
+    if len(text) > max_length:
+        # A very long sentence, cut at a word instead.
+        space = text.rfind(" ", 0, max_length)
+        return space + 1 if space > 0 else max_length
+    return 0
+
+
+class EditBudget:
+    # Telegram allows roughly one message per second per chat and ~30 per second overall.
+    # Shared across every streaming reply so all chats together stay under the global bot limit.
+    def __init__(self, edits_per_second=25) -> None:
+        self.interval = 1 / edits_per_second
+        self.next_edit = 0.0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = monotonic()
+            if now < self.next_edit:
+                return False
+            self.next_edit = now + self.interval
+            return True
+
+    def pause(self, seconds):
+        with self.lock:
+            self.next_edit = max(self.next_edit, monotonic() + seconds)
+
+
+class StreamingReply:
+    # A placeholder message that is progressively edited while a completion streams in.
+    # Intermediate edits are plain text and best-effort: they are skipped rather than delayed
+    # when a rate limit would be exceeded, only the final edit is guaranteed.
+    def __init__(
+        self, bot, chat_id, budget: EditBudget, min_interval=1.0, placeholder="...", max_length=4096
+    ) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.budget = budget
+        self.min_interval = min_interval
+        self.placeholder = placeholder
+        self.max_length = max_length
+        self.message = None
+        self.last_text = placeholder
+        self.next_edit = 0.0
+
+    def start(self):
+        self.message = self.bot.send_message(self.chat_id, self.placeholder)
+        self.next_edit = monotonic() + self.min_interval
+        return self.message
+
+    def next_update(self, text: str):
+        # Text to edit the message with now, or None if this update should be skipped.
+        if self.message is None or not text.strip():
+            return None
+        if len(text) > self.max_length:
+            text = text[: self.max_length - 3] + "..."
+        if text == self.last_text or monotonic() < self.next_edit or not self.budget.take():
+            return None
+        return text
+
+    def retry_after(self, e: Exception):
+        # Seconds Telegram asked to wait when an edit was rate limited, None otherwise.
+        retry_after = RETRY_AFTER_RE.search(str(e))
+        if retry_after is None:
+            return None
+        # Back off this chat and everybody else, the limit is shared by the whole bot.
+        wait = int(retry_after.group(1))
+        self.next_edit = monotonic() + wait
+        self.budget.pause(wait)
+        return wait
+
+    def finish_failed(self, e: Exception, attempt):
+        # Seconds to wait before the final edit is tried again. It is the answer, so it waits
+        # for a rate limit once instead of failing.
+        wait = self.retry_after(e)
+        if wait is None or attempt:
+            raise e
+        return wait
+
+    def update_failed(self, e: Exception):
+        if self.retry_after(e) is None and "message is not modified" not in str(e):
+            print(f"!! Failed to update streaming message: {e} !!")
+
+    def edited(self, text: str):
+        self.last_text = text
+        self.next_edit = monotonic() + self.min_interval
+
+    def fits(self, text: str):
+        return self.message is not None and len(text) <= self.max_length
+
+    def update(self, text: str):
+        text = self.next_update(text)
+        if text is None:
+            return
+        try:
+            self.edit(text)
+        except Exception as e:
+            self.update_failed(e)
+
+    def finish(self, text: str, parse_mode=None):
+        if text == self.last_text and parse_mode is None:
+            return self.message
+        for attempt in range(2):
+            try:
+                return self.edit(text, parse_mode)
+            except Exception as e:
+                if "message is not modified" in str(e):
+                    return self.message
+                sleep(self.finish_failed(e, attempt))
+
+    def discard(self):
+        if self.message is None:
+            return
+        try:
+            self.bot.delete_message(self.chat_id, self.message.message_id)
+        except Exception as e:
+            print(f"!! Failed to delete streaming message: {e} !!")
+        self.message = None
+
+    def edit(self, text, parse_mode=None):
+        result = self.bot.edit_message_text(
+            text, chat_id=self.chat_id, message_id=self.message.message_id, parse_mode=parse_mode
+        )
+        self.edited(text)
+        return result
+
+
+class AsyncStreamingReply(StreamingReply):
+    # Same as StreamingReply, for telebot's AsyncTeleBot.
+    async def start(self):
+        self.message = await self.bot.send_message(self.chat_id, self.placeholder)
+        self.next_edit = monotonic() + self.min_interval
+        return self.message
+
+    async def update(self, text: str):
+        text = self.next_update(text)
+        if text is None:
+            return
+        try:
+            await self.edit(text)
+        except Exception as e:
+            self.update_failed(e)
+
+    async def finish(self, text: str, parse_mode=None):
+        if text == self.last_text and parse_mode is None:
+            return self.message
+        for attempt in range(2):
+            try:
+                return await self.edit(text, parse_mode)
+            except Exception as e:
+                if "message is not modified" in str(e):
+                    return self.message
+                await asyncio.sleep(self.finish_failed(e, attempt))
+
+    async def discard(self):
+        if self.message is None:
+            return
+        try:
+            await self.bot.delete_message(self.chat_id, self.message.message_id)
+        except Exception as e:
+            print(f"!! Failed to delete streaming message: {e} !!")
+        self.message = None
+
+    async def edit(self, text, parse_mode=None):
+        result = await self.bot.edit_message_text(
+            text, chat_id=self.chat_id, message_id=self.message.message_id, parse_mode=parse_mode
+        )
+        self.edited(text)
+        return result
+
+
+class VoiceReply:
+    # Speaks a completion while it streams in. The text is cut at sentence boundaries and every
+    # piece goes to TTS on the executor as soon as it is complete, voice notes are sent in order
+    # as they become ready. The first piece is short so audio starts quickly, later ones are
+    # longer so the answer doesn't turn into dozens of tiny voice notes.
+    def __init__(
+        self, bot, chat_id, tts, executor=None, first_length=40, min_length=300, max_length=4000
+    ) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.tts = tts
+        self.executor = executor
+        self.first_length = first_length
+        self.min_length = min_length
+        self.max_length = max_length  # TTS input limit is 4096 characters
+        self.spoken = 0  # Characters of the text already handed to TTS
+        self.segments = deque()
+        self.pieces = 0
+
+    def next_pieces(self, text: str, final=False):
+        # Pieces of text that are ready to be spoken, text is the whole response so far.
+        pieces = []
+        while text:
+            rest = text[self.spoken :]
+            min_length = self.min_length if self.pieces else self.first_length
+            cut = sentence_cut(rest, min_length, self.max_length)
+            if not cut:
+                if final and rest.strip():
+                    cut = len(rest)
+                else:
+                    break
+            self.spoken += cut
+            if rest[:cut].strip():
+                pieces.append(rest[:cut].strip())
+                self.pieces += 1
+        return pieces
+
+    def update(self, text: str):
+        for piece in self.next_pieces(text):
+            self.segments.append(self.executor.submit(self.tts, piece))
+        self.send_ready()
+
+    def send_ready(self, wait=False):
+        while self.segments and (wait or self.segments[0].done()):
+            audio = self.segments.popleft().result()
+            if audio:
+                self.bot.send_voice(self.chat_id, audio)
+
+    def finish(self, text: str):
+        # Returns the number of voice notes the response was spoken in.
+        for piece in self.next_pieces(text, final=True):
+            self.segments.append(self.executor.submit(self.tts, piece))
+        self.send_ready(wait=True)
+        return self.pieces
+
+    def discard(self):
+        for segment in self.segments:
+            segment.cancel()
+        self.segments.clear()
+
+
+class AsyncVoiceReply(VoiceReply):
+    # Same as VoiceReply, TTS runs in tasks of the event loop instead of an executor.
+    async def update(self, text: str):
+        for piece in self.next_pieces(text):
+            self.segments.append(asyncio.create_task(self.tts(piece)))
+        await self.send_ready()
+
+    async def send_ready(self, wait=False):
+        while self.segments and (wait or self.segments[0].done()):
+            audio = await self.segments.popleft()
+            if audio:
+                await self.bot.send_voice(self.chat_id, audio)
+
+    async def finish(self, text: str):
+        for piece in self.next_pieces(text, final=True):
+            self.segments.append(asyncio.create_task(self.tts(piece)))
+        await self.send_ready(wait=True)
+        return self.pieces
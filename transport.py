@@ -0,0 +1,226 @@
+import httpx
+import openai
+import requests
+import threading
+from telebot import apihelper
+from requests.adapters import HTTPAdapter
+from metrics import Metrics
+
+# Connections to OpenAI and Telegram are kept open and shared by every worker, a new one costs a
+# TCP and TLS handshake on the critical path of a message.
+
+# Seconds. The read timeout is the longest silence allowed while waiting for data, every chunk of
+# a streamed answer resets it. The total only applies where the client supports it (aiohttp),
+# Telegram API calls of the async bot only get the total (see use_async_telegram_pool).
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+WRITE_TIMEOUT = 30  # Uploading a photo or a voice note
+POOL_TIMEOUT = 10  # Waiting for a connection of a full pool
+TOTAL_TIMEOUT = 120
+KEEPALIVE_EXPIRY = 90  # Idle connections older than this are closed
+
+try:
+    # HTTP/2 lets every OpenAI request share one connection, it needs `pip install httpx[http2]`.
+    import h2
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+def openai_timeout():
+    return httpx.Timeout(
+        connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT
+    )
+
+
+class PoolStats:
+    # Requests sent through a connection pool and the connections it had to open for them.
+    # Exported as gauges named http_<name>_<stat>.
+    def __init__(self, metrics: Metrics, name, max_connections) -> None:
+        self.name = name
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections = 0
+        self.handshakes = 0  # TLS
+        self.opened = None  # Returns (connections, handshakes) when the pool counts them itself
+        for stat in ("requests", "in_flight", "connections", "handshakes"):
+            metrics.gauge(f"http_{name}_{stat}", lambda stat=stat: self.stats()[stat])
+
+    def started(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def connected(self, tls):
+        with self.lock:
+            self.connections += 1
+            self.handshakes += tls
+
+    def trace(self, event, info):
+        # httpcore's trace extension, called for every step of an httpx request.
+        if event == "connection.connect_tcp.complete":
+            self.connected(False)
+        elif event == "connection.start_tls.complete":
+            with self.lock:
+                self.handshakes += 1
+        elif event.endswith(".send_request_headers.started"):
+            self.started()
+        elif event.endswith((".response_closed.complete", ".response_closed.failed")):
+            self.finished()
+
+    async def atrace(self, event, info):
+        self.trace(event, info)
+
+    def stats(self):
+        with self.lock:
+            connections, handshakes = self.connections, self.handshakes
+            stats = {
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "max_connections": self.max_connections,
+            }
+        if self.opened is not None:
+            connections, handshakes = self.opened()
+        stats["connections"] = connections
+        stats["handshakes"] = handshakes
+        stats["reused"] = 1 - connections / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+
+def openai_http_client(stats: PoolStats, asynchronous=False):
+    # Keeps up to max_connections connections to OpenAI open between requests.
+    limits = httpx.Limits(
+        max_connections=stats.max_connections,
+        max_keepalive_connections=stats.max_connections,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    if asynchronous:
+
+        async def trace(request):
+            request.extensions["trace"] = stats.atrace
+
+        return openai.DefaultAsyncHttpxClient(
+            limits=limits, timeout=openai_timeout(), http2=HTTP2, event_hooks={"request": [trace]}
+        )
+
+    def trace(request):
+        request.extensions["trace"] = stats.trace
+
+    return openai.DefaultHttpxClient(
+        limits=limits, timeout=openai_timeout(), http2=HTTP2, event_hooks={"request": [trace]}
+    )
+
+
+class TelegramSession(requests.Session):
+    # telebot sends file downloads without a timeout, they would wait forever on a stuck
+    # connection.
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+class TelegramAdapter(HTTPAdapter):
+    def __init__(self, stats: PoolStats) -> None:
+        self.stats = stats
+        # pool_connections is the number of hosts kept, api.telegram.org is the only one. Past
+        # pool_maxsize, connections are still opened but closed after their request.
+        super().__init__(pool_connections=2, pool_maxsize=stats.max_connections)
+        stats.opened = self.opened
+
+    def send(self, request, **kwargs):
+        self.stats.started()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            self.stats.finished()
+
+    def opened(self):
+        # Every urllib3 pool counts the connections it opened.
+        connections = handshakes = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                handshakes += pool.num_connections if pool.scheme == "https" else 0
+        return connections, handshakes
+
+
+def use_telegram_pool(stats: PoolStats):
+    # telebot makes a session per thread unless it is given one, every worker then opened its
+    # own connections to Telegram. This one is shared by all of them.
+    session = TelegramSession()
+    adapter = TelegramAdapter(stats)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    apihelper.session = session
+    apihelper.CONNECT_TIMEOUT = CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = READ_TIMEOUT
+    return session
+
+
+def use_async_telegram_pool(stats: PoolStats):
+    # Same for AsyncTeleBot, whose aiohttp session is made by asyncio_helper.session_manager.
+    import aiohttp
+    from telebot import asyncio_helper
+
+    manager = asyncio_helper.session_manager
+    trace_config = aiohttp.TraceConfig()
+
+    async def request_start(session, context, params):
+        context.tls = params.url.scheme == "https"
+        stats.started()
+
+    async def request_end(session, context, params):
+        stats.finished()
+
+    async def connection_created(session, context, params):
+        stats.connected(getattr(context, "tls", False))
+
+    trace_config.on_request_start.append(request_start)
+    trace_config.on_request_end.append(request_end)
+    trace_config.on_request_exception.append(request_end)
+    trace_config.on_connection_create_end.append(connection_created)
+
+    async def create_session():
+        manager.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=stats.max_connections,
+                limit_per_host=stats.max_connections,
+                keepalive_timeout=KEEPALIVE_EXPIRY,
+                ssl=manager.ssl_context,
+            ),
+            # Only file downloads use the session's timeouts. telebot gives every API call a
+            # ClientTimeout of its own with just a total, REQUEST_TIMEOUT below.
+            timeout=aiohttp.ClientTimeout(
+                total=TOTAL_TIMEOUT, connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            ),
+            trace_configs=[trace_config],
+        )
+        return manager.session
+
+    manager.create_session = create_session
+    asyncio_helper.REQUEST_LIMIT = stats.max_connections
+    asyncio_helper.REQUEST_TIMEOUT = TOTAL_TIMEOUT
+
+
+def pools_report(*pools: PoolStats):
+    lines = ["Connections (requests, opened, TLS handshakes, reused, in flight / max):"]
+    for pool in pools:
+        s = pool.stats()
+        lines.append(
+            f"{pool.name}: {s['requests']}, {s['connections']}, {s['handshakes']}, "
+            f"{s['reused']:.0%}, {s['in_flight']} ({s['max_in_flight']}) / {s['max_connections']}"
+        )
+    return "\n".join(lines)
@@ -1,14 +1,23 @@
-from PIL import Image
-import tiktoken
+from functools import lru_cache
+from itertools import accumulate
+from bisect import bisect_left
 import base64
 import math
 import io
 import re
 
 
+def pil_image():
+    # PIL and tiktoken are slow to import and only needed once messages come in, so they are
+    # imported on first use, or ahead of time by a warm-up thread (see main.py).
+    from PIL import Image
+
+    return Image
+
+
 def ensure_jpeg(image_bytes):
     # Load the image from bytes
-    image = Image.open(io.BytesIO(image_bytes))
+    image = pil_image().open(io.BytesIO(image_bytes))
 
     # Check if image is already JPEG
     if image.format == "JPEG":
@@ -21,36 +30,50 @@ def ensure_jpeg(image_bytes):
         return new_image_bytes
 
 
-def calculate_image_token_cost(image_bytes, detail="high"):
+def vision_image_size(width, height, detail="high"):
+    # Size OpenAI scales an image to before processing it.
     # Complying with https://platform.openai.com/docs/guides/vision
+    if detail == "low":
+        # Low detail images are processed as a 512x512 image
+        scaling_factor = 512 / max(width, height)
+        return int(width * scaling_factor), int(height * scaling_factor)
+
+    # Scale down to fit within 2048x2048 if necessary
+    if width > 2048 or height > 2048:
+        aspect_ratio = width / height
+        if aspect_ratio > 1:  # Width is greater than height
+            width = 2048
+            height = int(2048 / aspect_ratio)
+        else:
+            height = 2048
+            width = int(2048 * aspect_ratio)
+
+    # Scale such that the shortest side is 768px
+    if width < height:
+        scaling_factor = 768 / width
+    else:
+        scaling_factor = 768 / height
+
+    return int(width * scaling_factor), int(height * scaling_factor)
+
+
+def calculate_image_token_cost(image_bytes, detail="high"):
     # Load the image from bytes
-    image = Image.open(io.BytesIO(image_bytes))
+    image = pil_image().open(io.BytesIO(image_bytes))
 
     # Get image dimensions
     width, height = image.size
 
+    return image_token_cost(width, height, detail)
+
+
+def image_token_cost(width, height, detail="high"):
+    # Complying with https://platform.openai.com/docs/guides/vision
     if detail == "low":
         # Fixed cost for low detail images
         return 85
     elif detail == "high":
-        # Scale down to fit within 2048x2048 if necessary
-        if width > 2048 or height > 2048:
-            aspect_ratio = width / height
-            if aspect_ratio > 1:  # Width is greater than height
-                width = 2048
-                height = int(2048 / aspect_ratio)
-            else:
-                height = 2048
-                width = int(2048 * aspect_ratio)
-
-        # Scale such that the shortest side is 768px
-        if width < height:
-            scaling_factor = 768 / width
-        else:
-            scaling_factor = 768 / height
-
-        new_width = int(width * scaling_factor)
-        new_height = int(height * scaling_factor)
+        new_width, new_height = vision_image_size(width, height, detail)
 
         # Calculate number of 512px squares needed
         num_squares_width = math.ceil(new_width / 512)
@@ -63,89 +86,310 @@ def calculate_image_token_cost(image_bytes, detail="high"):
         return total_cost
 
 
-def count_tokens_in_messages(messages):
-    encoding = tiktoken.get_encoding("cl100k_base")
+JPEG_QUALITY = {"low": 80, "high": 85}
+
+
+def prepare_image(image_bytes, detail="high"):
+    # Resizes the image to the size OpenAI would use anyway and makes sure it's a JPEG, so we
+    # don't upload pixels that are thrown away. Returns the JPEG bytes and its width and height.
+    image = pil_image().open(io.BytesIO(image_bytes))
+    width, height = image.size
+    new_width, new_height = vision_image_size(width, height, detail)
+
+    # Never upscale, that only makes the upload bigger.
+    if new_width >= width or new_height >= height:
+        if image.format == "JPEG":
+            return image_bytes, width, height
+        new_width, new_height = width, height
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if (new_width, new_height) != image.size:
+        image = image.resize((new_width, new_height), pil_image().LANCZOS)
+    with io.BytesIO() as output:
+        image.save(output, format="JPEG", quality=JPEG_QUALITY[detail], optimize=True)
+        return output.getvalue(), new_width, new_height
+
+
+def image_part(jpeg_bytes, width, height, detail="high"):
+    # Image content part for a user message. Its size and token cost are kept along with it so
+    # counting tokens never has to decode the image again, api_messages strips them.
+    base64_image = base64.b64encode(jpeg_bytes).decode("utf-8")
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": detail},
+        "width": width,
+        "height": height,
+        "tokens": image_token_cost(width, height, detail),
+    }
+
+
+def pick_photo_size(photo_sizes, detail="high"):
+    # Telegram sends every photo in several sizes, from smallest to largest. Pick the smallest
+    # one that doesn't need upscaling to what OpenAI processes for this detail level.
+    for photo_size in sorted(photo_sizes, key=lambda p: p.width * p.height):
+        new_width, new_height = vision_image_size(photo_size.width, photo_size.height, detail)
+        if photo_size.width >= new_width and photo_size.height >= new_height:
+            return photo_size
+    return max(photo_sizes, key=lambda p: p.width * p.height)
+
+
+# Models tokenized with o200k_base, everything else falls back to cl100k_base.
+O200K_MODEL_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-4.5", "gpt-5", "o1", "o3", "o4", "chatgpt-4o")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=None):
+    # Loading the BPE ranks is expensive, so every encoding is loaded once and shared.
+    import tiktoken
+
+    if model:
+        if model.startswith(O200K_MODEL_PREFIXES):
+            return tiktoken.get_encoding("o200k_base")
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=256)
+def count_text_tokens(text: str, model=None):
+    return len(get_encoding(model).encode(text))
+
+
+def count_message_tokens(message: dict, model=None):
+    encoding = get_encoding(model)
+    num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+    for key, value in message.items():
+        if key == "tokens":
+            continue
+        if isinstance(value, list):
+            prompt = ""
+            for item in value:
+                if item["type"] == "text":
+                    prompt = item["text"]
+                elif item["type"] == "image_url" and "tokens" in item:
+                    num_tokens += item["tokens"]
+                elif item["type"] == "image_url":
+                    # Images that don't come from image_part, decode them to get their size.
+                    # data:image/jpeg;base64,
+                    b64_str_image: str = item["image_url"]["url"].replace(
+                        "data:image/jpeg;base64", ""
+                    )
+                    image_bytes = base64.b64decode(b64_str_image.encode("utf-8"))
+                    num_tokens += calculate_image_token_cost(
+                        image_bytes, item["image_url"]["detail"]
+                    )
+        else:
+            prompt = value
+        num_tokens += len(encoding.encode(prompt))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
+
+
+def count_tokens_in_messages(messages, model=None):
     num_tokens = 0
     for message in messages:
-        num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        for key, value in message.items():
-            if isinstance(value, list):
-                for item in value:
-                    if item["type"] == "text":
-                        prompt = item["text"]
-                    elif item["type"] == "image_url":
-                        # data:image/jpeg;base64,
-                        b64_str_image: str = item["image_url"]["url"].replace(
-                            "data:image/jpeg;base64", ""
-                        )
-                        image_bytes = base64.b64decode(b64_str_image.encode("utf-8"))
-                        num_tokens += calculate_image_token_cost(
-                            image_bytes, item["image_url"]["detail"]
-                        )
-            else:
-                prompt = value
-            num_tokens += len(encoding.encode(prompt))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens += -1  # role is always required and always 1 token
+        # Messages remember their own token count, so they are only tokenized once.
+        if "tokens" not in message:
+            message["tokens"] = count_message_tokens(message, model)
+        num_tokens += message["tokens"]
     num_tokens += 2  # every reply is primed with <im_start>assistant
     return num_tokens
 
 
-def escape_outside(text):
-    # Define patterns for markdown styles
-    patterns = [
-        r"\*(.+?)\*",  # Bold
-        r"_(.+?)_",  # Italic
-        r"__(.+?)__",  # Underline
-        r"~(.+?)~",  # Strikethrough
-        r"\|\|(.+?)\|\|",  # Spoiler
-        r"\`(.+?)\`",  # Single line code block
-    ]
-
-    # Function to escape special characters, skipping valid markdown
-    def escape_chars(match):
-        # Check each pattern to see if it matches the entire match group
-        for pattern in patterns:
-            if re.fullmatch(pattern, match.group(0)):
-                return match.group(0)  # Return the markdown unchanged
-        # If no patterns match, escape all matched special characters
-        return re.sub(r"([_*\[\]()~`>#+\-=|{}.!])", r"\\\1", match.group(0))
-
-    # This regex matches any markdown pattern or any special character
-    combined_pattern = r"(\`.+?\`|\*.+?\*|_.+?_|__.+?__|~.+?~|\|\|.+?\|\||[_*[\]()~`>#+\-=|{}.!])"
-
-    temp = re.sub(combined_pattern, escape_chars, text)
-    res = ""
-    for i, char in enumerate(temp):
-        if char in "!(){}[].>#=+-":
-            if i > 0:
-                if temp[i - 1] != "\\":
-                    res += "\\" + char
-                else:
-                    res += char
-            else:
-                res += "\\" + char
-        else:
-            res += char
+TRIM_POLICIES = (
+    "drop_oldest",  # Drop messages from the start of the conversation, one by one
+    "keep_pairs",  # Same, but never keep an assistant reply without the prompt that caused it
+)
+
+
+def trim_messages(messages, trim_to, model=None, policy="keep_pairs", pin_system=True):
+    # Drops the oldest messages until the conversation fits in trim_to tokens and returns the
+    # trimmed messages and the number of tokens removed. The last message (the prompt) is always
+    # kept, as are the system messages it starts with when pin_system is set.
+    if policy not in TRIM_POLICIES:
+        raise ValueError(f"Unknown trim policy '{policy}'. Valid policies are {TRIM_POLICIES}")
+    total = count_tokens_in_messages(messages, model)
+    if total <= trim_to or len(messages) < 2:
+        return messages, 0
+
+    end = len(messages) - 1
+    start = 0
+    while pin_system and start < end and messages[start]["role"] == "system":
+        start += 1
+    # prefix[i] is the number of tokens removed by dropping messages[start : start + i]
+    prefix = list(accumulate((m["tokens"] for m in messages[start:end]), initial=0))
+    cut = min(bisect_left(prefix, total - trim_to), end - start) + start
+    if policy == "keep_pairs":
+        while cut < end and messages[cut]["role"] != "user":
+            cut += 1
+    return messages[:start] + messages[cut:], prefix[cut - start]
 
+
+API_MESSAGE_KEYS = ("role", "content", "name")
+API_PART_KEYS = ("type", "text", "image_url")
+
+
+def api_messages(messages):
+    # Strip the bookkeeping we keep in messages, the API only accepts the documented fields.
+    res = []
+    for message in messages:
+        message = {key: value for key, value in message.items() if key in API_MESSAGE_KEYS}
+        if isinstance(message["content"], list):
+            message["content"] = [
+                {key: value for key, value in part.items() if key in API_PART_KEYS}
+                for part in message["content"]
+            ]
+        res.append(message)
     return res
 
 
+def cached_tokens(usage):
+    # Prompt tokens OpenAI served from its prompt cache, not every model reports them.
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+# Characters MarkdownV2 needs escaped outside of entities.
+MARKDOWN_SPECIAL_RE = re.compile(r"[_*\[\]()~`>#+\-=|{}.!]")
+# Characters that are still escaped inside bold, italic, etc. unless they already are.
+MARKDOWN_INNER_RE = re.compile(r"(?<!\\)([!(){}\[\].>#=+\-])")
+# Characters that open an entity (`code`, *bold*, _italic_, ~strike~) closed by the same one.
+MARKDOWN_ENTITIES = "`*_~"
+
+
+def escape_outside(text: str):
+    # Escapes MarkdownV2 special characters, leaving `code`, *bold*, _italic_, __underline__,
+    # ~strikethrough~ and ||spoiler|| (all within a single line) as they are. Single pass: every
+    # special character either opens an entity, found with a bounded str.find, or is escaped.
+    res = []
+    pos = 0
+    line_end = -1
+    length = len(text)
+    search = MARKDOWN_SPECIAL_RE.search
+    match = search(text, pos)
+    while match is not None:
+        start = match.start()
+        char = text[start]
+        if start > line_end:
+            line_end = text.find("\n", start)
+            if line_end == -1:
+                line_end = length
+        end = -1
+        if char in MARKDOWN_ENTITIES:
+            # At least one character between the delimiters, like ".+?" would.
+            end = text.find(char, start + 2, line_end)
+            if end != -1:
+                end += 1
+        elif char == "|" and text.startswith("|", start + 1):
+            end = text.find("||", start + 3, line_end)
+            if end != -1:
+                end += 2
+        res.append(text[pos:start])
+        if end == -1:
+            res.append("\\" + char)
+            pos = start + 1
+        else:
+            res.append(MARKDOWN_INNER_RE.sub(r"\\\1", text[start:end]))
+            pos = end
+        match = search(text, pos)
+    res.append(text[pos:])
+    return "".join(res)
+
+
 def escape_markdown(text: str):
-    res = ""
-    triple_backticks = "```"
-    escape_inside_block = "\\`"
-    inside_code = False
-    for t in text.split(triple_backticks):
-        if inside_code:
-            for ec in escape_inside_block:
-                if ec in t:
-                    t = t.replace(ec, f"\\{ec}")
+    # Code blocks only need backslashes and backticks escaped, everything else is escaped
+    # with escape_outside.
+    parts = text.split("```")
+    for i, part in enumerate(parts):
+        if i % 2:
+            parts[i] = part.replace("\\", "\\\\").replace("`", "\\`")
         else:
-            t = escape_outside(t)
-        res += t
-        res += triple_backticks
-        inside_code = not inside_code
-    if res.count(triple_backticks) % 2 != 0:
+            parts[i] = escape_outside(part)
+    res = "```".join(parts) + "```"
+    if res.count("```") % 2 != 0:
         res = res[:-3]
     return res
+
+
+# Tokens that open or close formatting, per parse mode. Escaped characters are matched first
+# so they are skipped.
+MARKUP_TOKEN_RE = {
+    "MarkdownV2": re.compile(r"\\.|```[\w+#-]*|\|\||__|[`*_~]", re.S),
+    "Markdown": re.compile(r"\\.|```[\w+#-]*|[`*_]", re.S),
+}
+# Room kept at the end of every part to close what is still open.
+MARKUP_RESERVE = 16
+
+
+def markup_state(text: str, parse_mode=None):
+    # Formatting still open at the end of text: (language of the open code block or None,
+    # open entities in the order they were opened).
+    token_re = MARKUP_TOKEN_RE.get(parse_mode)
+    if token_re is None:
+        return None, []
+    fence = None
+    entities = []
+    for match in token_re.finditer(text):
+        token = match.group(0)
+        if token.startswith("```"):
+            fence = None if fence is not None else token[3:]
+        elif fence is not None or token[0] == "\\":
+            continue
+        elif entities and entities[-1] == "`":
+            # Nothing is formatting inside inline code.
+            if token == "`":
+                entities.pop()
+        elif token in entities:
+            entities.remove(token)
+        else:
+            entities.append(token)
+    return fence, entities
+
+
+def message_cut(text: str, limit):
+    # Where to cut text so the first part is at most limit long: after a blank line, a line or
+    # a word if one of them is in the second half, never between a backslash and the character
+    # it escapes or in the middle of a delimiter like ``` or ||.
+    cut = limit
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, limit // 2, limit)
+        if position != -1:
+            cut = position + len(separator)
+            break
+    start = cut
+    while cut > 1 and text[cut - 1] == text[cut] and text[cut] in "`|_*~":
+        cut -= 1
+        if start - cut > 2 or cut < limit // 2:
+            # Longer than any delimiter, a run like that is cut where it is.
+            cut = start
+            break
+    backslashes = len(text[:cut]) - len(text[:cut].rstrip("\\"))
+    if backslashes % 2:
+        cut -= 1
+    return max(cut, 1)
+
+
+def split_message(text: str, max_length=4096, parse_mode=None):
+    # Telegram messages can't be longer than 4096 characters. Text is cut at paragraphs, lines
+    # or words, and code blocks and entities (MarkdownV2 or Markdown) still open at a cut are
+    # closed at the end of one part and opened again at the start of the next, so every part
+    # parses on its own.
+    parts = []
+    prefix = ""
+    while len(prefix) + len(text) > max_length:
+        cut = message_cut(text, max_length - len(prefix) - MARKUP_RESERVE)
+        part = prefix + text[:cut]
+        fence, entities = markup_state(part, parse_mode)
+        closing = "".join(reversed(entities))
+        prefix = "".join(entities)
+        if fence is not None:
+            closing = ("" if part.endswith("\n") else "\n") + "```" + closing
+            prefix += f"```{fence}\n"
+        parts.append(part + closing)
+        text = text[cut:]
+    parts.append(prefix + text)
+    return parts
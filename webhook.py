@@ -0,0 +1,101 @@
+import hmac
+import json
+import queue
+import threading
+import traceback
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_path(url):
+    # Path the server has to answer on for the webhook set to url.
+    return urllib.parse.urlparse(url).path or "/"
+
+
+class WebhookServer:
+    # Receives Telegram updates over HTTP. Requests are acknowledged as soon as the update is
+    # queued, a single ingest thread hands them to on_update in the order they arrived.
+    def __init__(
+        self, on_update, secret_token, host="0.0.0.0", port=8443, path="/telegram", max_queue=1000
+    ) -> None:
+        # Without a secret anybody who finds the port could post updates as any user.
+        if not secret_token:
+            raise ValueError("The webhook needs a secret token")
+        self.on_update = on_update
+        self.secret_token = secret_token
+        self.path = path
+        self.updates = queue.Queue(maxsize=max_queue)
+        self.received = 0
+        self.rejected = 0
+        self.httpd = ThreadingHTTPServer((host, port), self.__handler())
+        self.httpd.daemon_threads = True
+        self.ingest = threading.Thread(target=self.__ingest_loop, name="webhook", daemon=True)
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                elif not hmac.compare_digest(
+                    self.headers.get(SECRET_HEADER, ""), server.secret_token
+                ):
+                    self.send_response(403)
+                else:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    self.send_response(server.accept(body))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def accept(self, body: bytes):
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            # Telegram will retry the update later.
+            self.rejected += 1
+            return 503
+        self.received += 1
+        return 200
+
+    def __ingest_loop(self):
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.on_update(update)
+            except Exception:
+                print(f"Failed to process update! Exception:\n {traceback.format_exc()}")
+
+    def serve_forever(self):
+        self.ingest.start()
+        host, port = self.httpd.server_address[:2]
+        print(f"Webhook listening on {host}:{port}{self.path}")
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            self.updates.put(None)
+            self.ingest.join()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "queue_depth": self.updates.qsize(),
+        }
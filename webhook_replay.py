@@ -0,0 +1,80 @@
+import json
+import secrets
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from time import sleep, monotonic
+from webhook import SECRET_HEADER, WebhookServer, webhook_path
+
+# Posts recorded Telegram updates to a webhook, to try the webhook mode locally.
+#
+#   python webhook_replay.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret <token>
+#
+# With --serve it also starts a WebhookServer that just prints what it receives, with a random
+# secret unless one is given.
+
+
+def load_updates(path):
+    with open(path, "r") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def post_update(url, secret, update):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode("utf-8"),
+        headers={"Content-Type": "application/json", SECRET_HEADER: secret},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates to a webhook")
+    parser.add_argument("updates", help="JSON list or JSON lines file with Telegram updates")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="", help="Required unless --serve is used")
+    parser.add_argument("--rate", type=float, default=0, help="Updates per second, 0 for no limit")
+    parser.add_argument("--serve", action="store_true", help="Start a printing webhook server")
+    args = parser.parse_args()
+    if not args.secret:
+        if not args.serve:
+            parser.error("--secret is required to post to a webhook")
+        args.secret = secrets.token_urlsafe(32)
+
+    server = None
+    if args.serve:
+        url = urllib.parse.urlparse(args.url)
+        server = WebhookServer(
+            lambda update: print(f"Received update {update.get('update_id')}"),
+            args.secret,
+            host=url.hostname,
+            port=url.port,
+            path=webhook_path(args.url),
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        sleep(0.2)
+
+    updates = load_updates(args.updates)
+    statuses = {}
+    start = monotonic()
+    for i, update in enumerate(updates):
+        if args.rate:
+            sleep(max(start + i / args.rate - monotonic(), 0))
+        status = post_update(args.url, args.secret, update)
+        statuses[status] = statuses.get(status, 0) + 1
+    elapsed = monotonic() - start
+
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s. Responses: {statuses}")
+    if server is not None:
+        sleep(0.2)
+        server.shutdown()